@@ -0,0 +1,134 @@
+"""
+Author: Ben.Sanders@NHS.net
+
+Benchmark the run transfer against a simulated network share
+
+Builds a synthetic MSR or LRM run folder, then times the transfer to a local
+folder through a SlowShare (see bin/fake_share.py) for each combination of
+copy buffer size and number of simultaneous copies. Each transfer is then
+repeated into the same folder to time a resumed transfer where everything
+has already been copied.
+
+e.g. python benchmark_transfer.py --style lrm --latency-ms 5 --bandwidth 80
+"""
+
+import argparse
+import contextlib
+import io
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import replace
+from functools import partial
+from pathlib import Path
+
+from bin.Config import config
+from bin.Transfer import BAMSTORE, DATASTORE, MyeloidTransfer
+from bin.fake_share import SlowShare, make_lrm_run, make_msr_run
+from bin.quick_copy import quickcopy
+from bin.settings import Settings, load_settings
+from bin.transfer_scheduler import TransferScheduler, format_bytes
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    """Read the benchmark options from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--style", choices=("msr", "lrm"), default="msr",
+                        help="Run folder layout to simulate")
+    parser.add_argument("--samples", type=int, default=8)
+    parser.add_argument("--fastq-mb", type=float, default=64,
+                        help="Size of each fastq (two per sample)")
+    parser.add_argument("--bam-mb", type=float, default=32)
+    parser.add_argument("--vcf-mb", type=float, default=8)
+    parser.add_argument("--bandwidth", type=float, default=100,
+                        help="Total MB/s to the share (0 for no limit)")
+    parser.add_argument("--stream", type=float, default=40,
+                        help="MB/s for a single copy (0 for no limit)")
+    parser.add_argument("--latency-ms", type=float, default=2,
+                        help="Round trip time to the share")
+    parser.add_argument("--buffers", default="1,16",
+                        help="Comma separated copy buffer sizes in MB")
+    parser.add_argument("--copies", default="1,4",
+                        help="Comma separated numbers of simultaneous copies")
+    parser.add_argument("--workdir", type=Path, default=None,
+                        help="Folder for the test data (default: a temporary folder)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show the transfer messages")
+    return parser.parse_args(argv)
+
+
+def run_transfer(settings: Settings, datadir: Path, targetdir: Path,
+                 share: SlowShare, copies: int) -> float:
+    """
+    Plan and run a transfer of datadir into targetdir through the share,
+    returning the time taken in seconds
+    """
+    plan = MyeloidTransfer.plan_transfer(settings, datadir, targetdir)
+    scheduler = TransferScheduler(
+        {DATASTORE: copies, BAMSTORE: max(copies // 2, 1)},
+        copy_function=share,
+        report_interval=3600,
+    )
+    starttime = time.monotonic()
+    scheduler.run(plan.jobs)
+    return time.monotonic() - starttime
+
+
+def main(argv: list):
+    """Build the test run and time each transfer configuration"""
+    args = parse_args(argv)
+    settings = load_settings(config)
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix="transfer_bench_"))
+    sourcedir = workdir / "source"
+    if sourcedir.exists():
+        shutil.rmtree(sourcedir)
+
+    make_run = make_lrm_run if args.style == "lrm" else make_msr_run
+    datadir = make_run(sourcedir, samples=args.samples,
+                       fastq_mb=args.fastq_mb, bam_mb=args.bam_mb,
+                       vcf_mb=args.vcf_mb)
+    runsize = sum(fpath.stat().st_size for fpath in sourcedir.rglob("*")
+                  if fpath.is_file())
+    print(f"INFO: Created {args.style.upper()} run in {sourcedir} "
+          f"({format_bytes(runsize)})")
+    print(f"INFO: Share: {args.bandwidth} MB/s total, {args.stream} MB/s per "
+          f"copy, {args.latency_ms} ms latency")
+
+    print(f"{'buffer':>8} {'copies':>6} {'transfer':>9} {'MB/s':>7} "
+          f"{'trips':>7} {'resume':>8}")
+    for buffer_mb in [int(value) for value in args.buffers.split(",")]:
+        for copies in [int(value) for value in args.copies.split(",")]:
+            targetdir = workdir / "target"
+            bamstore = workdir / "bamstore"
+            for folder in (targetdir, bamstore):
+                if folder.exists():
+                    shutil.rmtree(folder)
+                folder.mkdir(parents=True)
+            runsettings = replace(settings, bam_store_dir=bamstore)
+
+            share = SlowShare(
+                partial(quickcopy, buffer_size=buffer_mb * 1024 * 1024),
+                args.bandwidth, args.stream, args.latency_ms,
+            )
+            # The transfer prints a line for every file, which would bury the
+            # results
+            output = (contextlib.nullcontext() if args.verbose
+                      else contextlib.redirect_stderr(io.StringIO()))
+            with output, contextlib.redirect_stdout(sys.stderr):
+                elapsed = run_transfer(runsettings, datadir, targetdir, share,
+                                       copies)
+                round_trips = share.round_trips
+                resumed = run_transfer(runsettings, datadir, targetdir, share,
+                                       copies)
+
+            rate = share.sent_bytes / 1024**2 / max(elapsed, 1e-6)
+            print(f"{buffer_mb:>6}MB {copies:>6} {elapsed:>8.1f}s "
+                  f"{rate:>7.1f} {round_trips:>7} {resumed:>7.1f}s")
+
+    if args.workdir is None:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
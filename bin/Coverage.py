@@ -2,66 +2,701 @@
 Author: Ben.Sanders@NHS.net
 
 Calculate coverage for a myeloid panel run
+
+Depths are read from the genome VCFs or the indexed BAMs, summarised per gene,
+ROI and hotspot base, and written to the Excel report and a JSON lines bundle.
+MyeloidCoverage runs this for a whole run folder using the settings from
+transfer.config; the functions below it can be used on their own.
 """
 
+import csv
 import sys
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
 
 # config is shared across multiple classes, so we load it up in its own module
 # to avoid repetition of the config parsing code
 from bin.Config import config
+from bin.bam_reader import find_bai, find_bam_files, read_bam
 from bin.bed_reader import BedReader
-from bin.excel_formatter import ExcelFormatter
-from bin.open_gzip import open_gzip, decompress_gzip
+from bin.coverage_state import CoverageState, file_hash, object_hash
+from bin.excel_formatter import write_report
+from bin.mmap_vcf import UnsortedVcfError, read_vcf_regions
+from bin.open_gzip import decompress_gzip, is_gzipped, open_gzip
+from bin.preflight import check_bed, report_settings_error
+from bin.result_bundle import ResultBundle
+from bin.sample_sheet import match_sample_files, read_sample_sheet
+from bin.settings import Settings, SettingsError, load_settings
+
+
+# ROIs with this in their name are hotspots, and have their per-base depths
+# kept
+HOTSPOT_MARKER = "hotspot"
+
+
+@dataclass
+class HotspotProfile:
+    """
+    Exact depths across a single hotspot ROI.
+
+    start and end are the BED (0-based) coordinates, and chrom is stored the
+    same way as BedReader (an int for numerical chromosomes). depths[i] is
+    the depth at 1-based position start + 1 + i, stored as an array of
+    unsigned ints to keep it small.
+    """
+    name: str
+    chrom: object
+    start: int
+    end: int
+    depths: array
+
+    @property
+    def positions(self) -> range:
+        """The 1-based positions matching depths"""
+        return range(self.start + 1, self.end + 1)
+
+    def to_dict(self) -> dict:
+        """Convert to a JSON serialisable dictionary"""
+        return {
+            "name": self.name,
+            "chrom": self.chrom,
+            "start": self.start,
+            "end": self.end,
+            "depths": self.depths.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, profile: dict):
+        """Create a HotspotProfile from the output of to_dict"""
+        profile = dict(profile)
+        profile["depths"] = array("I", profile["depths"])
+        return cls(**profile)
+
+
+@dataclass
+class CoverageResult:
+    """
+    Coverage summary for a single sample.
+
+    path is the genome VCF or BAM the coverage was read from. genes maps each
+    BED gene name to [length, covered], where covered is the number of bases
+    at or above mindepth. regions lists [chrom, start, end, name, covered] for
+    each BED ROI, and hotspots is a list of HotspotProfiles, both in BED order.
+    """
+    sampleid: str
+    path: Path
+    mindepth: int
+    genes: dict
+    regions: list = field(default_factory=list)
+    hotspots: list = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        """Convert to a JSON serialisable dictionary"""
+        return {
+            "sampleid": self.sampleid,
+            "path": str(self.path),
+            "mindepth": self.mindepth,
+            "genes": self.genes,
+            "regions": self.regions,
+            "hotspots": [profile.to_dict() for profile in self.hotspots],
+        }
+
+    @classmethod
+    def from_dict(cls, result: dict):
+        """Create a CoverageResult from the output of to_dict"""
+        result = dict(result)
+        result["path"] = Path(result["path"])
+        result["hotspots"] = [HotspotProfile.from_dict(profile)
+                              for profile in result.get("hotspots", [])]
+        return cls(**result)
+
+
+def sample_id_from_path(fpath) -> str:
+    """
+    Extract just the sample ID from a genome VCF or BAM path (everything
+    before the first underscore of the filename)
+    """
+    return Path(fpath).parts[-1].split("_")[0]
+
+
+def find_coverage_files(runfolder) -> list:
+    """
+    Glob all genome VCFs in the run folder - these contain the coverage
+    information.
+
+    If there are none, but there are gzipped (LRM-style) VCFs, these are
+    decompressed first. The gzipped originals are kept, as they are listed
+    in the transfer manifest and md5sums.txt.
+    """
+    runfolder = Path(runfolder)
+    coveragefiles = list(runfolder.glob("*.genome.vcf"))
+    if not coveragefiles:
+        # If there are gzipped VCFs, unzip *all* of them, not just
+        # genome VCFs.
+        for covfile in runfolder.glob("*.vcf.gz"):
+            # Decompress to a .vcf file
+            decompress_gzip(covfile)
+
+        # regenerate the coveragefiles
+        coveragefiles = list(runfolder.glob("*.genome.vcf"))
+    return sorted(coveragefiles)
+
+
+def read_vcf(vcf: Path) -> dict:
+    """
+    Extract the postiion and coverage information from a genome VCF
+
+    Returns a nested dictionary of {chrom: {pos: depth}}, skipping any
+    positions with zero depth. Both gzipped and uncompressed files can be
+    read.
+    """
+    coveragedict = {}
+    chrom = None
+
+    with open_gzip(vcf) as fhandle:
+        for line in fhandle:
+            line = line.rstrip().split()
+
+            # Skip header lines
+            if line[0].startswith("#"):
+                continue
+
+            # Check if the chromosome has changed
+            if str(chrom) != line[0]:
+                try:
+                    chrom = int(line[0])
+                except ValueError:
+
+                    # This will store non-numeric chromosomes (e.g. X & Y)
+                    # as strings, while storing the others are ints
+                    chrom = line[0]
+                print(
+                    f"INFO: Reading chromosome {chrom} coverage",
+                    file=sys.stderr,
+                )
+
+            # POS is the second line of the file
+            pos = int(line[1])
+
+            # In a genome VCF there is a DP= field in the INFO column with
+            # the depth. We just have to make sure that this can cope with
+            # multiple INFO fields
+            info = line[7].split(";")
+            for infofield in info:
+                if infofield.startswith("DP="):
+                    depth = int(infofield.split("=")[1])
+
+            # Skip adding if depth is zero
+            if depth == 0:
+                continue
+
+            # Add to the coverage dictionary
+            # try/excepts cover the possibilities of sample not added and
+            # chromosome not added. Then POS and DEPTH can be.
+            try:
+                coveragedict[chrom][pos] = depth
+            except KeyError:
+                try:
+                    coveragedict[chrom] = {pos: depth}
+                except KeyError:
+                    coveragedict = {chrom: {pos: depth}}
+    return coveragedict
+
+
+def region_coverage(coveragedict: dict, bedregions: list,
+                    mindepth: int) -> list:
+    """
+    Count the bases in each ROI that are at or above the minimum required
+    coverage, returning [chrom, start, end, name, covered] for each ROI in
+    BED order
+    """
+    regions = []
+
+    # Process each ROI in turn (could do in parallel but it's quick enough)
+    for chrom, start, end, name in bedregions:
+        # BED format is 0-indexed while coverage file is 1-indexed. So we
+        # have to add 1 to the start and end
+        # If a position is not found, assume the depth is 0
+        chromdepths = coveragedict.get(chrom, {})
+        covered = 0
+        for pos in range(start + 1, end + 1):
+            if chromdepths.get(pos, 0) >= mindepth:
+                covered += 1
+        regions.append([chrom, start, end, name, covered])
+    return regions
+
+
+def summarise_genes(regions: list) -> dict:
+    """
+    Summarise the output of region_coverage per gene, rather than per
+    exon/amplicon, as {gene: [length, covered]}
+    """
+    # Use a new dictionary, which will store coverage details per-gene
+    genedict = {}
+    for _, start, end, name, covered in regions:
+        # If the gene is already in the dictionary, we want to update the
+        # length and coverage. If not, we want to add it.
+        try:
+            genedict[name][0] += end - start
+            genedict[name][1] += covered
+        except KeyError:
+            genedict[name] = [end - start, covered]
+    return genedict
+
+
+def intersect_bed(coveragedict: dict, bedregions: list, mindepth: int) -> dict:
+    """
+    Use bed ROI list to extract only the parts of the coverage dict that:
+
+    1) Are within the ROI
+    2) Are above the minimum required coverage
+
+    and return as a new dictionary which summarises this per gene, rather
+    than per exon/amplicon
+    """
+    return summarise_genes(region_coverage(coveragedict, bedregions,
+                                           mindepth))
+
+
+def is_hotspot(name: str) -> bool:
+    """Check if a BED ROI name is a hotspot region"""
+    return HOTSPOT_MARKER in name.lower()
+
+
+def hotspot_depths(coveragedict: dict, bedregions: list) -> list:
+    """
+    Extract the depth at every base of each hotspot ROI from the coverage
+    dict. Positions missing from the coverage dict have a depth of 0, the
+    same as intersect_bed.
+    """
+    profiles = []
+    for chrom, start, end, name in bedregions:
+        if not is_hotspot(name):
+            continue
+        chromdepths = coveragedict.get(chrom, {})
+        depths = array("I", (chromdepths.get(pos, 0)
+                             for pos in range(start + 1, end + 1)))
+        profiles.append(HotspotProfile(name, chrom, start, end, depths))
+    return profiles
+
+
+def write_hotspot_depths(results: list, path: Path) -> Path:
+    """
+    Write the hotspot depths for every sample to a tab separated file, with
+    one row per sample per base
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    print(f"INFO: Writing hotspot depths to {path.name}", file=sys.stderr)
+    with open(path, "w", newline="", encoding="utf-8") as fhandle:
+        writer = csv.writer(fhandle, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "region", "chrom", "pos", "depth",
+                         "mindepth"])
+        for result in sorted(results, key=lambda result: result.sampleid):
+            for profile in result.hotspots:
+                for pos, depth in zip(profile.positions, profile.depths):
+                    writer.writerow([result.sampleid, profile.name,
+                                     profile.chrom, pos, depth,
+                                     result.mindepth])
+    return path
+
+
+def shard_regions(bedregions: list) -> list:
+    """
+    Split the BED regions into one shard per chromosome, keeping the BED order
+    within each shard
+    """
+    shards = {}
+    for region in bedregions:
+        shards.setdefault(region[0], []).append(region)
+    return list(shards.values())
+
+
+def summarise_coverage(coveragedict: dict, bedregions: list,
+                       mindepth: int) -> tuple:
+    """
+    Return the per-ROI counts (see region_coverage) and the hotspot depths
+    from a coverage dict
+    """
+    return (region_coverage(coveragedict, bedregions, mindepth),
+            hotspot_depths(coveragedict, bedregions))
+
+
+def shard_coverage(source: str, fpath: Path, regions: list, mindepth: int,
+                   min_mapq: int = 0, min_baseq: int = 0) -> tuple:
+    """
+    Calculate the per-ROI counts and hotspot depths for a single shard of
+    regions. Only the depths for this shard are held in memory.
+
+    This runs in a worker process, so it has to be a module level function.
+    """
+    if source == "bam":
+        coveragedict = read_bam(fpath, regions, min_mapq, min_baseq)
+    else:
+        coveragedict = read_vcf_regions(fpath, regions)
+    return summarise_coverage(coveragedict, regions, mindepth)
+
+
+def sharded_coverage(executor: Executor, source: str, fpath: Path,
+                     bedregions: list, mindepth: int, min_mapq: int = 0,
+                     min_baseq: int = 0) -> tuple:
+    """
+    Calculate the per-ROI counts and hotspot depths for a single sample by
+    processing each chromosome concurrently on the executor, then merging the
+    results. The results are identical to the sequential path, as each ROI is
+    counted independently.
+    """
+    futures = [
+        executor.submit(shard_coverage, source, fpath, regions, mindepth,
+                        min_mapq, min_baseq)
+        for regions in shard_regions(bedregions)
+    ]
+    partials = [future.result() for future in futures]
+
+    # Put everything back into BED order, in case the BED file isn't grouped
+    # by chromosome
+    order = {}
+    for index, region in enumerate(bedregions):
+        order.setdefault(tuple(region), index)
+    regions = sorted(
+        (region for counts, _ in partials for region in counts),
+        key=lambda region: order[tuple(region[:4])],
+    )
+    hotspots = sorted(
+        (profile for _, profiles in partials for profile in profiles),
+        key=lambda profile: order[(profile.chrom, profile.start, profile.end,
+                                   profile.name)],
+    )
+    return regions, hotspots
+
+
+def compute_sample_coverage(vcf, bedregions: list, mindepth: int,
+                            executor: Executor = None,
+                            sampleid: str = None) -> CoverageResult:
+    """
+    Calculate the per-gene coverage summary for a single genome VCF.
+
+    bedregions is the parsed ROI list from BedReader, so a single BED file
+    can be read once and reused across many samples.
+
+    Uncompressed VCFs are memory-mapped and only the ROIs are read. If an
+    executor is given, the chromosomes are processed concurrently. Gzipped
+    (or unsorted) VCFs are read line by line.
+
+    If sampleid is not given, it is taken from the file name.
+    """
+    vcfpath = Path(vcf)
+    sampleid = sampleid or sample_id_from_path(vcfpath)
+    print(f"INFO: Reading coverage file for {sampleid}", file=sys.stderr)
+    # Make sure the file can be opened
+    assert vcfpath.is_file(), f"ERROR: File {vcfpath} cannot be opened"
+    if not is_gzipped(vcfpath):
+        try:
+            if executor is not None:
+                regions, hotspots = sharded_coverage(executor, "vcf", vcfpath,
+                                                     bedregions, mindepth)
+            else:
+                regions, hotspots = shard_coverage("vcf", vcfpath, bedregions,
+                                                   mindepth)
+            return CoverageResult(sampleid, vcfpath, mindepth,
+                                  summarise_genes(regions), regions, hotspots)
+        except UnsortedVcfError as error:
+            print(f"WARNING: {error}, reading the whole file", file=sys.stderr)
+
+    coveragedict = read_vcf(vcfpath)
+    print(f"INFO: Analysing coverage for sample {sampleid}", file=sys.stderr)
+    regions, hotspots = summarise_coverage(coveragedict, bedregions, mindepth)
+    return CoverageResult(sampleid, vcfpath, mindepth,
+                          summarise_genes(regions), regions, hotspots)
+
+
+def compute_bam_coverage(bam, bedregions: list, mindepth: int,
+                         min_mapq: int = 0, min_baseq: int = 0,
+                         executor: Executor = None,
+                         sampleid: str = None) -> CoverageResult:
+    """
+    Calculate the per-gene coverage summary for a single indexed BAM.
+
+    Reads below min_mapq and bases below min_baseq are not counted. If an
+    executor is given, the chromosomes are processed concurrently. If
+    sampleid is not given, it is taken from the file name.
+    """
+    bampath = Path(bam)
+    sampleid = sampleid or sample_id_from_path(bampath)
+    print(f"INFO: Reading BAM file for {sampleid}", file=sys.stderr)
+    if executor is not None:
+        regions, hotspots = sharded_coverage(executor, "bam", bampath,
+                                             bedregions, mindepth, min_mapq,
+                                             min_baseq)
+    else:
+        regions, hotspots = shard_coverage("bam", bampath, bedregions,
+                                           mindepth, min_mapq, min_baseq)
+    return CoverageResult(sampleid, bampath, mindepth,
+                          summarise_genes(regions), regions, hotspots)
+
 
 class MyeloidCoverage():
     """
-    Handle generating coverage for an entire run folder
+    Handle generating coverage for an entire run folder. settings is the
+    loaded transfer.config. If it isn't given (e.g. when rerunning the
+    coverage on its own) it is read here, and the BED file is checked against
+    the report panels, as the transfer pre-flight checks haven't been run.
     """
 
-    def __init__(self, runfolder: str):
+    def __init__(self, runfolder: str, settings: Settings = None):
         self.runfolder = Path(runfolder)
-        
+        if settings is None:
+            try:
+                settings = load_settings(config)
+                problems = check_bed(settings)
+                if problems:
+                    raise SettingsError(problems)
+            except SettingsError as error:
+                report_settings_error(error)
+        self.settings = settings
+
         print(
             f"INFO: Gathering coverage files for run {self.runfolder.parts[-2]}",
             file=sys.stderr,
         )
 
-        # Glob all genome VCFs in the run folder - these contain the
-        # coverage information
-        # DEV: This will need to allow for LRM gzipped genome vcfs.
-        #      Should be ok to use "*.genome.vcf*" to capture both
-        coveragefiles = list(self.runfolder.glob("*.genome.vcf"))
-        try:
-            assert len(coveragefiles) > 0, "ERROR: No genome vcf files detected"
-        except AssertionError:
-            # If there are gzipped VCFs, unzip *all* of them, not just
-            # genome VCFs.
-            coveragefiles = list(self.runfolder.glob("*.vcf.gz"))
-            for covfile in coveragefiles:
-                # Decompress to a .vcf file
-                decompress_gzip(covfile, delete_original=True)
-
-            # regenerate the coveragefiles
-            coveragefiles = list(self.runfolder.glob("*.genome.vcf"))
-
         # Load the BED file target regions
         # BED file has the full path in transfer.config, so it doesn't need to
         # be resolved relative to the script/executable
-        self.bedfile = BedReader(Path(config.get("coverage", "bedfile")))
+        self.bedfile = BedReader(settings.bedfile)
         self.bedregions = self.bedfile.bedfile
 
-        # Analyse the coverage for each genome vcf file
-        # Use the filename as key in the output dictionary
-        outputdict = {}
-        for covfile in coveragefiles:
-            outputdict[covfile] = SampleCoverage(
-                                                 covfile, self.bedregions
-                                                ).coverage
+        # The required minimum depth of coverage is set from the config file
+        self.mindepth = settings.mindepth
+
+        # Coverage is normally taken from the genome VCFs, but can be
+        # calculated directly from the BAM files instead
+        self.source = settings.coverage_source
+        self.min_mapq = settings.min_mapq
+        self.min_baseq = settings.min_baseq
+        inputs = self.find_inputs()
+        if not inputs:
+            print(f"ERROR: No samples found to analyse in {self.runfolder}",
+                  file=sys.stderr)
+            sys.exit(1)
+        inputfiles = [inputfile for _, inputfile in inputs]
+
+        # Results from a previous run are reused for any input file that
+        # hasn't changed, as long as the settings are the same
+        self.outputpath = self.runfolder / "Coverage"
+        bedhash = file_hash(self.bedfile.fpath)
+        state = CoverageState(
+            self.outputpath / f"{self.runfolder.name}_coverage_state.json",
+            {
+                "bed": bedhash,
+                "mindepth": self.mindepth,
+                "source": self.source,
+                "min_mapq": self.min_mapq,
+                "min_baseq": self.min_baseq,
+            },
+        )
+
+        # Each sample can be split by chromosome across several processes, so
+        # a run with only a few deep samples still uses all the cores
+        workers = settings.shard_workers
+        self.executor = ProcessPoolExecutor(workers) if workers > 1 else None
+
+        # Results are streamed to the bundle as each sample is finished
+        bundle = ResultBundle(
+            self.outputpath / f"{self.runfolder.name}_coverage.jsonl.gz",
+            {
+                "runid": self.runfolder.parts[-2],
+                "analysis": self.runfolder.name,
+                "software_version": settings.version,
+                "mindepth": self.mindepth,
+                "source": self.source,
+                "min_mapq": self.min_mapq,
+                "min_baseq": self.min_baseq,
+                "bedfile": self.bedfile.fname,
+                "bed_sha256": bedhash,
+            },
+        )
+
+        # Analyse the coverage for each new or changed input file
+        self.results = []
+        try:
+            with bundle:
+                for sampleid, inputfile in inputs:
+                    cached = state.cached(inputfile)
+                    if cached is not None and cached["sampleid"] == sampleid:
+                        print(f"INFO: Using saved coverage for {sampleid}",
+                              file=sys.stderr)
+                        result = CoverageResult.from_dict(cached)
+                    else:
+                        result = self.compute(sampleid, inputfile)
+                        state.update(inputfile, result.to_dict())
+                    self.results.append(result)
+                    bundle.add(result)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+        state.prune(inputfiles)
+
+        # Write the results into a correctly formatted Excel workbook.
+        # The workbook has always been named after the analysis folder.
+        # If nothing has changed since it was last written, leave it alone.
+        layout = settings.layout
+        layout_hash = object_hash(asdict(layout))
+        workbook = self.outputpath / f"{self.runfolder.name}_Coverage.xlsx"
+        hotspotfile = (self.outputpath
+                       / f"{self.runfolder.name}_hotspot_depths.tsv")
+        if (state.workbook_current(workbook, layout_hash)
+                and hotspotfile.is_file()):
+            print(f"INFO: {workbook.name} is already up to date",
+                  file=sys.stderr)
+        else:
+            write_report(self.results, layout, workbook,
+                         runid=self.runfolder.name)
+            write_hotspot_depths(self.results, hotspotfile)
+            state.set_workbook(workbook, layout_hash)
+        state.save()
+
+    def compute(self, sampleid: str, inputfile: Path) -> CoverageResult:
+        """
+        Calculate the coverage for a single genome VCF or BAM, depending on
+        the coverage source
+        """
+        if self.source == "bam":
+            return compute_bam_coverage(inputfile, self.bedregions,
+                                        self.mindepth, self.min_mapq,
+                                        self.min_baseq, self.executor,
+                                        sampleid)
+        return compute_sample_coverage(inputfile, self.bedregions,
+                                       self.mindepth, self.executor, sampleid)
+
+    def find_inputs(self) -> list:
+        """
+        Return a list of (sample ID, input file) for the samples to analyse.
+
+        The samples are taken from SampleSheetUsed.csv (copied to the run
+        folder by the transfer). If there is no sample sheet, fall back to
+        finding input files by name.
+        """
+        samplesheet = self.runfolder.parent / "SampleSheetUsed.csv"
+        if not samplesheet.is_file():
+            print(
+                f"INFO: No {samplesheet.name} found, finding samples from file names",
+                file=sys.stderr,
+            )
+            return self.find_inputs_by_name()
+
+        try:
+            samples = read_sample_sheet(samplesheet)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+        print(f"INFO: {len(samples)} samples listed in {samplesheet.name}",
+              file=sys.stderr)
+        if self.source == "bam":
+            found, missing, extra = self.find_sample_bams(samples)
+        else:
+            found, missing, extra = self.find_sample_vcfs(samples)
+
+        # If nothing matches, the sheet probably doesn't belong to this
+        # analysis, so go back to using the file names
+        if samples and not found:
+            print(
+                f"WARNING: None of the samples in {samplesheet.name} match the "
+                "input files, finding samples from file names instead",
+                file=sys.stderr,
+            )
+            return self.find_inputs_by_name()
+
+        # Report any differences between the sample sheet and the run folder
+        # before starting the coverage calculations
+        if missing:
+            print(
+                "WARNING: No input file found for samples: "
+                f"{', '.join(sample.name for sample in missing)}",
+                file=sys.stderr,
+            )
+        if extra:
+            print(
+                "WARNING: Ignoring files not in the sample sheet: "
+                f"{', '.join(fpath.name for fpath in extra)}",
+                file=sys.stderr,
+            )
+        return [(sample.name, inputfile) for sample, inputfile in found]
+
+    def find_inputs_by_name(self) -> list:
+        """
+        Return a list of (sample ID, input file) for every genome VCF (or BAM)
+        in the run, taking the sample IDs from the file names
+        """
+        if self.source == "bam":
+            inputfiles = self.find_bams()
+        else:
+            inputfiles = find_coverage_files(self.runfolder)
+        return [(sample_id_from_path(inputfile), inputfile)
+                for inputfile in inputfiles]
+
+    def find_sample_vcfs(self, samples: list) -> tuple:
+        """
+        Find the genome VCF for each sample in the run folder. LRM runs have
+        gzipped VCFs, which are decompressed first. The gzipped originals are
+        kept, so the transfer manifest still matches the run folder.
+        """
+        found, missing, extra = match_sample_files(samples, self.runfolder,
+                                                   ".genome.vcf")
+        if missing:
+            gzipped, missing, _ = match_sample_files(missing, self.runfolder,
+                                                     ".genome.vcf.gz")
+            for sample, gzpath in gzipped:
+                decompress_gzip(gzpath)
+                found.append((sample, gzpath.with_suffix("")))
+            found.sort(key=lambda match: match[0].number)
+        return found, missing, extra
+
+    def find_sample_bams(self, samples: list) -> tuple:
+        """
+        Find the indexed BAM for each sample, in the BAM store if they are
+        there, otherwise in the run folder
+        """
+        for folder in (self.bamstore, self.runfolder):
+            found, missing, extra = match_sample_files(samples, folder, ".bam")
+            if found:
+                break
+        indexed = []
+        for sample, bam in found:
+            try:
+                find_bai(bam)
+                indexed.append((sample, bam))
+            except FileNotFoundError:
+                print(f"WARNING: Skipping {bam.name} as it has no index",
+                      file=sys.stderr)
+                missing.append(sample)
+        return indexed, missing, extra
+
+    @property
+    def bamstore(self) -> Path:
+        """The folder in the temporary BAM store for this run"""
+        runid = self.runfolder.parts[-2]
+        return self.settings.bam_store_dir / runid
 
-        # Use ExcelFormatter to write the results into a correclty formatted
-        # Excel workbook
-        ExcelFormatter(outputdict)
+    def find_bams(self) -> list:
+        """
+        BAM files are copied to the temporary BAM store rather than the run
+        folder, so look there first. Fall back to the run folder in case the
+        BAMs were not sent to the store.
+        """
+        bamstore = self.bamstore
+        bamfiles = find_bam_files(bamstore) if bamstore.is_dir() else []
+        if not bamfiles:
+            bamfiles = find_bam_files(self.runfolder)
+        if not bamfiles:
+            print(
+                f"ERROR: No indexed BAM files found in {bamstore} or {self.runfolder}",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        return bamfiles
 
     @property
     def get_runfolder(self):
@@ -78,21 +713,19 @@ class SampleCoverage():
     """
     Generate a coverage report for a single file
 
-    DEV: Update this to handle both gzipped and uncompressed vcfs
+    Thin wrapper around compute_sample_coverage that reads the minimum depth
+    from the config file.
     """
 
     def __init__(self, vcf: str, bedfile: list):
         self.vcfpath = Path(vcf)
         self.outputpath = self.vcfpath.parent / "Coverage"
-        # Extract just the sample ID from the genome VCF path
-        self.sampleid = self.vcfpath.parts[-1].split("_")[0]
-        print(f"INFO: Reading coverage file for {self.sampleid}",
-              file=sys.stderr)
-        # Make sure the file can be opened
-        assert self.vcfpath.is_file(), "ERROR: File {} cannot be opened"
+        self.sampleid = sample_id_from_path(self.vcfpath)
         self.bedregions = bedfile
-        self.coveragedict = self.read_vcf(self.vcfpath)
-        self.genedict = self.intersect_bed()
+        self.result = compute_sample_coverage(
+            self.vcfpath, self.bedregions, config.getint("coverage", "mindepth")
+        )
+        self.genedict = self.result.genes
 
     @property
     def coverage(self) -> dict:
@@ -105,110 +738,5 @@ class SampleCoverage():
     def read_vcf(vcf: Path) -> dict:
         """
         Extract the postiion and coverage information from a genome VCF
-
-        DEV: open gzipped vcf too! Might need to be handled as a function - so
-        we can try opening compressed or uncompressed and just return the file
-        handle. Does that still then work with the "with" construct?
-        """
-        coveragedict = {}
-        chrom = None
-
-        with open_gzip(vcf) as fhandle:
-            for line in fhandle:
-                line = line.rstrip().split()
-
-                # Skip header lines
-                if line[0].startswith("#"):
-                    continue
-
-                # Check if the chromosome has changed
-                if str(chrom) != line[0]:
-                    try:
-                        chrom = int(line[0])
-                    except ValueError:
-
-                        # This will store non-numeric chromosomes (e.g. X & Y)
-                        # as strings, while storing the others are ints
-                        chrom = line[0]
-                    print(
-                        f"INFO: Reading chromosome {chrom} coverage",
-                        file=sys.stderr,
-                    )
-
-                # POS is the second line of the file
-                pos = int(line[1])
-
-                # In a genome VCF there is a DP= field in the INFO column with
-                # the depth. We just have to make sure that this can cope with
-                # multiple INFO fields
-                info = line[7].split(";")
-                for field in info:
-                    if field.startswith("DP="):
-                        depth = int(field.split("=")[1])
-
-                # Skip adding if depth is zero
-                if depth == 0:
-                    continue
-
-                # Add to the coverage dictionary
-                # try/excepts cover the possibilities of sample not added and
-                # chromosome not added. Then POS and DEPTH can be.
-                try:
-                    coveragedict[chrom][pos] = depth
-                except KeyError:
-                    try:
-                        coveragedict[chrom] = {pos: depth}
-                    except KeyError:
-                        coveragedict = {chrom: {pos: depth}}
-        return coveragedict
-
-    def intersect_bed(self) -> dict:
-        """
-        Use bed ROI list to extract only the parts of the coverage dict that:
-
-        1) Are within the ROI
-        2) Are above the minimum required coverage
-
-        and return as a new dictionary which summarises this per gene, rather
-        than per exon/amplicon
         """
-        print(
-            f"INFO: Analysing coverage for sample {self.sampleid}",
-            file=sys.stderr,
-        )
-
-        # Use a new dictionary, which will store coverage details per-gene
-        genedict = {}
-
-        # The required minimum depth of coverage is set from the config file
-        mindepth = config.getint("coverage", "mindepth")
-
-        # Process each ROI in turn (could do in parallel but it's quick enough)
-        for roi in self.bedregions:
-            chrom = roi[0]
-            start = roi[1]
-            end = roi[2]
-            name = roi[3]
-
-            # If the gene is already in the dictionary, we want to update the
-            # length If not, we want to add it.
-            # NOTE: The dict value is a list of length and coverage, and I
-            #       haven't Figured out a way to create and update a new list
-            #       with dict.get()
-            try:
-                genedict[name][0] = genedict[name][0] + (end - start)
-            except KeyError:
-                genedict[name] = [(end - start), 0]
-
-            # BED format is 0-indexed while coverage file is 1-indexed. So we
-            # have to add 1 to the start and end
-            for pos in range(start + 1, end + 1):
-                try:
-                    if self.coveragedict[chrom][pos] >= mindepth:
-                        genedict[name][1] += 1
-                    genedict[name][1] = genedict[name][1]
-                except KeyError:
-                    # If nothing found, assume the depth is 0
-                    # print("WARNING: Position not found", file=sys.stderr)
-                    genedict[name][1] = genedict[name][1]
-        return genedict
+        return read_vcf(vcf)
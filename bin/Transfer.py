@@ -15,15 +15,43 @@ the sequencing run to the backup directory.
 
 import sys
 import tkinter as tk
+from dataclasses import dataclass
+from functools import partial
 from tkinter import filedialog
 from pathlib import Path
 
-from shutil import copytree
-
 # config is shared across multiple classes, so we load it up in its own module
 # to avoid repetition of the config parsing code
 from bin.Config import config
+from bin.preflight import report_settings_error, run_preflight
 from bin.quick_copy import quickcopy
+from bin.settings import Settings, SettingsError, load_settings
+from bin.transfer_scheduler import (
+    CopyJob,
+    TransferScheduler,
+    PRIORITY_BULK,
+    PRIORITY_CRITICAL,
+    PRIORITY_METADATA,
+)
+from bin.verify_transfer import verify_transfer
+
+# Names of the destination pools, which have separate concurrency limits
+DATASTORE = "datastore"
+BAMSTORE = "bamstore"
+
+
+@dataclass
+class TransferPlan:
+    """
+    The destination folders for a run and the list of CopyJobs to run.
+    bamstore is None if BAMs are not being copied.
+    """
+    runid: str
+    newrundir: Path
+    newdatadir: Path
+    newalignmentdir: Path
+    bamstore: Path
+    jobs: list
 
 
 class MyeloidTransfer():
@@ -31,19 +59,39 @@ class MyeloidTransfer():
     Handles file copy operations to move Myeloid data to the network drive.
     """
     def __init__(self, datadir: str = None):
+        # Check the whole config file before doing anything else, so any
+        # mistakes are reported straight away
+        try:
+            self.settings = load_settings(config)
+        except SettingsError as error:
+            report_settings_error(error)
+
         # Get the run folder and target folder
-        print(
-            f"INFO: Default source directory: {config.get('directories', 'source-dir')}"
-        )
-        print(
-            f"INFO: Default target directory: {config.get('directories', 'target-dir')}"
-        )
+        print(f"INFO: Default source directory: {self.settings.source_dir}")
+        print(f"INFO: Default target directory: {self.settings.target_dir}")
 
         # Get the folder details from the user
-        datadir, targetdir = self.get_details_tk(datadir)
+        datadir, targetdir = self.get_details_tk(self.settings, datadir)
+
+        # Work out what needs copying, and check that everything needed for
+        # the transfer and coverage report is in place before starting
+        self.plan = self.plan_transfer(self.settings, datadir, targetdir)
+        run_preflight(self.settings, self.plan)
 
         # Run the data transfer to the network
-        self.newdatadir = self.transfer_files(datadir, targetdir)
+        self.newdatadir = self.transfer_files(datadir, targetdir, self.plan)
+
+        # Check the copies match the originals before the run can be removed
+        # from the MiSeq
+        if self.settings.verify:
+            result = verify_transfer(
+                self.plan,
+                workers=self.settings.verify_workers,
+                buffer_size=self.settings.copy_buffer_size,
+                sample_size=self.settings.verify_sample_size,
+            )
+            if not result.passed:
+                sys.exit(1)
 
     @property
     def newdatadirectory(self):
@@ -54,7 +102,8 @@ class MyeloidTransfer():
         """
         return self.newdatadir
 
-    def transfer_files(self, datadir: Path, targetdir: Path) -> str:
+    def transfer_files(self, datadir: Path, targetdir: Path,
+                       plan: TransferPlan = None) -> str:
         """
         Transfer the essential run files from the MiSeq run data folder to the
         backup target folder.
@@ -63,6 +112,76 @@ class MyeloidTransfer():
         print(f"INFO: Selected destination folder: {targetdir}",
                                                         file=sys.stderr)
 
+        if plan is None:
+            plan = self.plan_transfer(self.settings, datadir, targetdir)
+        self.plan = plan
+
+        print(f"INFO: Creating new folder {plan.newdatadir}", file=sys.stderr)
+
+        # Try to create the new analyis folder (e.g. /Myeloid_1.2)
+        # If this already exists we want to halt - should not be overwritten
+        try:
+            plan.newdatadir.mkdir(parents=True)
+        except FileExistsError:
+            print(
+                "INFO: The run folder already exists, but existing files should not be replaced by this script.",
+                file=sys.stderr,
+            )
+        # Don't overwrite an existing analysis folder - print a message and exit
+        try:
+            # This makes the alignment folder, which will only exist if it's
+            # been previously analysed so this one *should* give an error
+            plan.newalignmentdir.mkdir(parents=True, exist_ok=True)
+        except FileNotFoundError:
+            print(
+                f"ERROR: Could not create folder {plan.newalignmentdir} due to missing or inaccessible parent",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+        # If the option is set, the BAM files go to the temporary BAM file
+        # store, so create the run folder there first
+        if plan.bamstore is not None:
+            try:
+                plan.bamstore.mkdir(parents=True, exist_ok=True)
+            except FileNotFoundError:
+                print(
+                    f"ERROR: Could not create folder {plan.bamstore} due to missing or inaccessible parent",
+                    file=sys.stderr,
+                )
+                sys.exit(1)
+
+        # Large buffers make a big difference to fastq/BAM copies over SMB
+        copy_function = partial(
+            quickcopy,
+            buffer_size=self.settings.copy_buffer_size,
+            preallocate=self.settings.preallocate,
+        )
+
+        # Run the copies concurrently, limiting the number of simultaneous
+        # copies to each destination. Small essential files are copied first.
+        scheduler = TransferScheduler(
+            {
+                DATASTORE: self.settings.max_datastore_copies,
+                BAMSTORE: self.settings.max_bamstore_copies,
+            },
+            copy_function=copy_function,
+            report_interval=self.settings.report_interval,
+        )
+        scheduler.run(plan.jobs)
+
+        # Return the new run data, so we can then use that to call the coverage
+        # module
+        return plan.newdatadir
+
+    @staticmethod
+    def plan_transfer(settings: Settings, datadir: Path,
+                      targetdir: Path) -> TransferPlan:
+        """
+        Work out the destination folders and the list of files to copy,
+        without creating or copying anything. settings is the loaded
+        transfer.config (see settings.py).
+        """
         # Extract the run ID from the data folder path
         # Since the MiSeq data directory structure is fixed, we know exactly
         # which section of the path has this, but we have to go from the end as
@@ -94,136 +213,81 @@ class MyeloidTransfer():
         # Create new folder in the target directory
         newrundir = targetdir / runid
         # this is the folder to hold the bams/vcfs
-        newdatadir = newrundir / f"Myeloid_{config.get('general', 'version')}"
+        newdatadir = newrundir / f"Myeloid_{settings.version}"
         # For Fastq backup
         newfastqdir = newrundir / "Data" / "Intensities" / "BaseCalls"
         # non-BAM/VCF files from the Alignment folder
         newalignmentdir = newfastqdir / "Alignment"
 
-        print(f"INFO: Creating new folder {newdatadir}", file=sys.stderr)
-
-        # Try to create the new analyis folder (e.g. /Myeloid_1.2)
-        # If this already exists we want to halt - should not be overwritten
-        try:
-            newdatadir.mkdir(parents=True)
-        except FileExistsError:
-            print(
-                "INFO: The run folder already exists, but existing files should not be replaced by this script.",
-                file=sys.stderr,
-            )
-        # Don't overwrite an existing analysis folder - print a message and exit
-        try:
-            # This makes the alignment folder, which will only exist if it's
-            # been previously analysed so this one *should* give an error
-            newalignmentdir.mkdir(parents=True, exist_ok=True)
-        except FileNotFoundError:
-            print(
-                f"ERROR: Could not create folder {newalignmentdir} due to missing or inaccessible parent",
-                file=sys.stderr,
-            )
-            sys.exit(1)
+        jobs = []
 
         # Use the list of file types in the config file and glob all matching
-        # files in the data directory, then use shutil.copyfile to copy
-        # (NOT move) to the target directory (newdatadir)
-        for filetype in config["directories"].getlist("filetypes"):
+        # files in the data directory, to copy (NOT move) to the target
+        # directory (newdatadir). These are needed for the coverage report,
+        # so go first.
+        for filetype in settings.filetypes:
             for oldfile in datadir.glob(filetype):
-                print(f"INFO: Moving {oldfile.name}", file=sys.stderr)
-                newfile = newdatadir / oldfile.name
-
-                # DEV: I don't know all the ways in which this might go wrong,
-                # so I'll rely on it just dying and raising an exception.
-                # I doubt I will want to handle them any other way than just
-                # exiting, but I might want to add a more friendly error
-                # message.
-                quickcopy(oldfile, newfile)
+                jobs.append(CopyJob(oldfile, newdatadir / oldfile.name,
+                                    DATASTORE, PRIORITY_CRITICAL))
 
         # Copy the Sample Sheet and the AmpliconCoverage file
-        # DEV: As above, this could go wrong in a few ways. Once these are
-        # known, add handlers These should also go to the new alignment folder
-        quickcopy(datadir / "SampleSheetUsed.csv", newrundir / "SampleSheetUsed.csv")
-        quickcopy(
-            datadir / "SampleSheetUsed.csv", newalignmentdir / "SampleSheetUsed.csv"
-        )
-        quickcopy(
-            datadir / "AmpliconCoverage_M1.tsv",
-            newrundir / "AmpliconCoverage_M1.tsv",
-        )
-        quickcopy(
-            datadir / "AmpliconCoverage_M1.tsv",
-            newalignmentdir / "AmpliconCoverage_M1.tsv",
-        )
-        # DEV: This file does not exist in LRM runs - handle missing
-        try:
-            quickcopy(
-                datadir / "DemultiplexSummaryF1L1.txt",
-                newrundir / "DemultiplexSummaryF1L1.txt",
-            )
-            quickcopy(
-                datadir / "DemultiplexSummaryF1L1.txt",
-                newalignmentdir / "DemultiplexSummaryF1L1.txt",
-            )
-        except FileNotFoundError:
-            # These files don't exist in LRM-style runs
-            pass
+        # These should also go to the new alignment folder
+        # DemultiplexSummaryF1L1.txt does not exist in LRM runs, so it is
+        # optional
+        for fname, optional in (
+            ("SampleSheetUsed.csv", False),
+            ("AmpliconCoverage_M1.tsv", False),
+            ("DemultiplexSummaryF1L1.txt", True),
+        ):
+            for newdir in (newrundir, newalignmentdir):
+                jobs.append(CopyJob(datadir / fname, newdir / fname, DATASTORE,
+                                    PRIORITY_CRITICAL, optional=optional))
+
         # There are also a couple of MiSeq files to be moved (to match
         # panels, I'm not sure if they're essential for repeating this)
-        quickcopy(rundir / "RunInfo.xml", newrundir / "RunInfo.xml")
-        quickcopy(rundir / "RunParameters.xml", newrundir / "RunParameters.xml")
-
-        quickcopy(
-            rundir / "TruSight-Myeloid-Manifest.txt",
-            newrundir / "TruSight-Myeloid-Manifest.txt",
-        )
-
-        # Copy the InterOp folder to the backup drive
-        # To copy a folder and it's files & subfolders, use shutil copytree()
-        copytree(
-            rundir / "InterOp",
-            newrundir / "InterOp",
-            dirs_exist_ok=True,
-            copy_function=quickcopy,
-        )
+        for fname in ("RunInfo.xml", "RunParameters.xml",
+                      "TruSight-Myeloid-Manifest.txt"):
+            jobs.append(CopyJob(rundir / fname, newrundir / fname, DATASTORE,
+                                PRIORITY_CRITICAL))
+
+        # Copy the InterOp folder, and it's files & subfolders, to the backup
+        # drive
+        interopdir = rundir / "InterOp"
+        for oldfile in sorted(interopdir.rglob("*")):
+            if oldfile.is_file():
+                jobs.append(CopyJob(
+                    oldfile,
+                    newrundir / "InterOp" / oldfile.relative_to(interopdir),
+                    DATASTORE,
+                    PRIORITY_METADATA,
+                ))
 
         # Copy the fastqs and the remaining folders so that the new data
         # directory is more in line with the setup of the panels and genotyping
-        # folder. Create the Data directory regardless of fast copying
-        if config.getboolean("general", "copy_fastqs"):
+        # folder.
+        if settings.copy_fastqs:
             print(f"INFO: Copying fastq files in {basecallsdir}", file=sys.stderr)
             for oldfile in basecallsdir.glob("*.fastq.gz"):
-                print(f"INFO: Moving {oldfile.name}", file=sys.stderr)
-                newfile = newfastqdir / oldfile.name
-                quickcopy(oldfile, newfile)
-
-        # If the option is set, copy the BAM files to the temporary BAM file
-        # store
-        if config.getboolean("general", "copy_bams"):
-            # First, create the run folder in the temp store
-            try:
-                # Add the run ID to the BAM store path
-                bamstore = Path(f"{config.get('directories', 'bam-store-dir')}\\{runid}")
-                bamstore.mkdir(parents=True, exist_ok=True)
-            except FileNotFoundError:
-                print(
-                    f"ERROR: Could not create folder {bamstore} due to missing or inaccessible parent",
-                    file=sys.stderr,
-                )
-                sys.exit(1)
-
-            # Copy the BAM and BAI files to the temp store
+                jobs.append(CopyJob(oldfile, newfastqdir / oldfile.name,
+                                    DATASTORE, PRIORITY_BULK))
+
+        # If the option is set, copy the BAM and BAI files to the temporary
+        # BAM file store
+        bamstore = None
+        if settings.copy_bams:
+            # Add the run ID to the BAM store path
+            bamstore = settings.bam_store_dir / runid
             for oldfile in datadir.glob("*.ba*"):
-                print(f"INFO: Moving {oldfile.name} to temporary BAM store",
-                      file=sys.stderr
-                     )
-                newfile = bamstore / oldfile.name
-                quickcopy(oldfile, newfile)
+                jobs.append(CopyJob(
+                    oldfile, bamstore / oldfile.name, BAMSTORE, PRIORITY_BULK,
+                    message=f"INFO: Moving {oldfile.name} to temporary BAM store",
+                ))
 
-        # Return the new run data, so we can then use that to call the coverage
-        # module
-        return newdatadir
+        return TransferPlan(runid, newrundir, newdatadir, newalignmentdir,
+                            bamstore, jobs)
 
     @staticmethod
-    def get_details_tk(datadir: str = None) -> tuple:
+    def get_details_tk(settings: Settings, datadir: str = None) -> tuple:
         """
         Opens file picker dialogues from tkinter if there is no command line input.
 
@@ -239,7 +303,7 @@ class MyeloidTransfer():
             # Select the source run folder
             root.filename = filedialog.askdirectory(
                 title="Select run folder",
-                initialdir=config.get("directories", "source-dir"),
+                initialdir=str(settings.source_dir),
             )
 
             # If the dialogue is closed, the program will raise an exception
@@ -285,10 +349,8 @@ class MyeloidTransfer():
                 sys.exit(1)
 
         # Set the destination folder
-        networkdir = config.get("directories", "target-dir")
-
         # DEV: Just for now return the defaults
-        targetdir = Path(networkdir)
+        targetdir = settings.target_dir
 
         # Return the two paths
         return (datadir, targetdir)
@@ -0,0 +1,372 @@
+"""
+BamReader
+=========
+
+Author: Ben.Sanders@NHS.net
+
+Calculate per-base depth over BED regions of interest directly from an
+indexed BAM file, without needing samtools or pysam.
+
+Only the parts of the BAM that the BAI index says can overlap the ROIs are
+decompressed, so the cost depends on the panel size rather than the BAM size.
+The output is the same {chrom: {pos: depth}} dictionary produced by
+Coverage.read_vcf, so it can be fed straight into Coverage.intersect_bed.
+
+Reads are filtered in the same way as `samtools depth` by default (unmapped,
+secondary, QC fail and duplicate reads are skipped), plus optional minimum
+mapping and base quality thresholds. Deletions and skipped bases are not
+counted towards depth.
+"""
+
+# Disable the "Consider using 'with'" warning, as BgzfReader keeps the BAM open
+# until it is closed (it is used as a context manager itself)
+# pylint: disable=R1732
+
+import struct
+import sys
+import zlib
+from bisect import bisect_right
+from pathlib import Path
+
+from bin.quick_copy import print_line
+
+# Reads with any of these flags set are ignored:
+# 0x4 unmapped, 0x100 secondary, 0x200 QC fail, 0x400 duplicate
+DEFAULT_EXCLUDE_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# CIGAR operations that consume the reference and the read respectively
+# (M, I, D, N, S, H, P, =, X)
+CONSUMES_REF = (True, False, True, True, False, False, False, True, True)
+CONSUMES_QUERY = (True, True, False, False, True, False, False, True, True)
+# Only aligned bases (M, =, X) contribute to depth
+ALIGNED_OPS = (0, 7, 8)
+
+# The BAI pseudo-bin holds metadata rather than alignment chunks
+PSEUDO_BIN = 37450
+# Size of each linear index window
+LINEAR_SHIFT = 14
+
+ALIGNMENT_STRUCT = struct.Struct("<iiBBHHHiiii")
+
+
+def reg2bins(beg: int, end: int) -> list:
+    """
+    List the BAI bins that may contain reads overlapping the zero-based,
+    half-open region [beg, end). Taken from the SAM specification.
+    """
+    bins = [0]
+    end -= 1
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+class BgzfReader():
+    """
+    Minimal BGZF reader supporting seeking to BAM virtual file offsets.
+
+    A virtual offset is the compressed offset of a BGZF block shifted left 16
+    bits, plus the offset within the decompressed block.
+    """
+
+    def __init__(self, fpath):
+        self.fhandle = open(fpath, "rb")
+        self.block_start = 0
+        self.next_block = 0
+        self.data = b""
+        self.offset = 0
+
+    def close(self):
+        """Close the underlying file"""
+        self.fhandle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _load_block(self, coffset: int) -> bool:
+        """
+        Read and decompress the block starting at coffset. Returns False at
+        the end of the file.
+        """
+        self.fhandle.seek(coffset)
+        header = self.fhandle.read(18)
+        if len(header) < 18:
+            self.data = b""
+            return False
+        # The BC subfield holding the block size is always the first (and
+        # usually only) extra subfield in BGZF, so BSIZE is at a fixed offset
+        xlen = struct.unpack_from("<H", header, 10)[0]
+        bsize = struct.unpack_from("<H", header, 16)[0]
+        remaining = self.fhandle.read(bsize + 1 - 18)
+        block = header + remaining
+        self.data = zlib.decompress(block[12 + xlen:bsize + 1 - 8], -15)
+        self.block_start = coffset
+        self.next_block = coffset + bsize + 1
+        self.offset = 0
+        return True
+
+    def seek(self, voffset: int):
+        """Move to a virtual file offset"""
+        coffset = voffset >> 16
+        if coffset != self.block_start or not self.data:
+            self._load_block(coffset)
+        self.offset = voffset & 0xFFFF
+
+    def tell(self) -> int:
+        """Return the current virtual file offset"""
+        # If the current block is exhausted, the next read starts at the
+        # beginning of the next block
+        if self.offset >= len(self.data) and self.data:
+            return self.next_block << 16
+        return (self.block_start << 16) | self.offset
+
+    def read(self, size: int) -> bytes:
+        """Read size decompressed bytes, crossing block boundaries if needed"""
+        chunks = []
+        while size > 0:
+            if self.offset >= len(self.data):
+                # Empty blocks (e.g. the EOF marker) are skipped
+                if not self._load_block(self.next_block):
+                    break
+                continue
+            chunk = self.data[self.offset:self.offset + size]
+            self.offset += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+
+def read_bai(fpath) -> list:
+    """
+    Read a BAI index into a list (one entry per reference sequence) of
+    (bins, linear_index) tuples, where bins maps the bin number to a list of
+    (start, end) virtual offset chunks.
+    """
+    with open(fpath, "rb") as fhandle:
+        data = fhandle.read()
+
+    if data[:4] != b"BAI\x01":
+        raise ValueError(f"ERROR: {fpath} is not a BAI index")
+
+    offset = 4
+    n_ref = struct.unpack_from("<i", data, offset)[0]
+    offset += 4
+    references = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        bins = {}
+        for _ in range(n_bin):
+            binnum, n_chunk = struct.unpack_from("<Ii", data, offset)
+            offset += 8
+            chunks = struct.unpack_from(f"<{n_chunk * 2}Q", data, offset)
+            offset += 16 * n_chunk
+            if binnum != PSEUDO_BIN:
+                bins[binnum] = list(zip(chunks[::2], chunks[1::2]))
+        n_intv = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        linear = struct.unpack_from(f"<{n_intv}Q", data, offset)
+        offset += 8 * n_intv
+        references.append((bins, linear))
+    return references
+
+
+def find_bai(bam: Path) -> Path:
+    """
+    Find the index for a BAM file, which may be named sample.bam.bai or
+    sample.bai
+    """
+    for candidate in (Path(f"{bam}.bai"), bam.with_suffix(".bai")):
+        if candidate.is_file():
+            return candidate
+    raise FileNotFoundError(f"ERROR: No BAI index found for {bam}")
+
+
+def find_bam_files(folder) -> list:
+    """
+    Glob all indexed BAM files in a folder. BAMs without an index are reported
+    and skipped, since they can't be read by region.
+    """
+    bamfiles = []
+    for bam in sorted(Path(folder).glob("*.bam")):
+        try:
+            find_bai(bam)
+        except FileNotFoundError:
+            print(f"WARNING: Skipping {bam.name} as it has no index",
+                  file=sys.stderr)
+            continue
+        bamfiles.append(bam)
+    return bamfiles
+
+
+def _merge_intervals(intervals: list) -> list:
+    """
+    Sort and merge overlapping (start, end) intervals. Used for both BAM
+    chunks (so no read is visited twice) and BED regions (so each base is
+    only counted once per read)
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class BamReader():
+    """
+    Read per-base depth from an indexed BAM over a list of BED regions
+    """
+
+    def __init__(self, bam, min_mapq: int = 0, min_baseq: int = 0,
+                 exclude_flags: int = DEFAULT_EXCLUDE_FLAGS):
+        self.bampath = Path(bam)
+        self.baipath = find_bai(self.bampath)
+        self.min_mapq = min_mapq
+        self.min_baseq = min_baseq
+        self.exclude_flags = exclude_flags
+        self.index = read_bai(self.baipath)
+        self.references = self.read_header()
+
+    def read_header(self) -> dict:
+        """
+        Read the BAM header and return a dictionary mapping each reference
+        sequence name to its ID (the position in the header list)
+        """
+        with BgzfReader(self.bampath) as bgzf:
+            if bgzf.read(4) != b"BAM\x01":
+                raise ValueError(f"ERROR: {self.bampath} is not a BAM file")
+            l_text = struct.unpack("<i", bgzf.read(4))[0]
+            bgzf.read(l_text)
+            n_ref = struct.unpack("<i", bgzf.read(4))[0]
+            references = {}
+            for refid in range(n_ref):
+                l_name = struct.unpack("<i", bgzf.read(4))[0]
+                name = bgzf.read(l_name).rstrip(b"\x00").decode("ascii")
+                bgzf.read(4)
+                references[name] = refid
+        return references
+
+    def region_chunks(self, refid: int, regions: list) -> list:
+        """
+        Use the BAI bins and linear index to get the merged list of BAM chunks
+        that could contain reads overlapping any of the regions
+        """
+        bins, linear = self.index[refid]
+        chunks = []
+        for start, end in regions:
+            # Any chunk ending before the linear index offset for the region
+            # start cannot contain overlapping reads
+            window = start >> LINEAR_SHIFT
+            minoffset = linear[window] if window < len(linear) else 0
+            for binnum in reg2bins(start, end):
+                for chunk in bins.get(binnum, ()):
+                    if chunk[1] > minoffset:
+                        chunks.append(chunk)
+        return _merge_intervals(chunks)
+
+    def depth(self, bedregions: list) -> dict:
+        """
+        Calculate the depth at every ROI base covered by at least one read.
+
+        Returns a dictionary of {chrom: {pos: depth}} using 1-based positions,
+        the same as Coverage.read_vcf.
+        """
+        # Group the ROIs by chromosome, keeping the BedReader chromosome (an
+        # int for numerical chromosomes) as the output key
+        bychrom = {}
+        for chrom, start, end, _ in bedregions:
+            bychrom.setdefault(chrom, []).append((start, end))
+
+        coveragedict = {}
+        with BgzfReader(self.bampath) as bgzf:
+            for chrom, regions in bychrom.items():
+                refid = self.references.get(str(chrom))
+                if refid is None or refid >= len(self.index):
+                    print_line(
+                        f"WARNING: Chromosome {chrom} not found in {self.bampath.name}"
+                    )
+                    continue
+                print_line(f"INFO: Reading chromosome {chrom} coverage")
+                depths = self.chromosome_depth(bgzf, refid,
+                                               _merge_intervals(regions))
+                if depths:
+                    coveragedict[chrom] = depths
+        return coveragedict
+
+    def chromosome_depth(self, bgzf: BgzfReader, refid: int,
+                         regions: list) -> dict:
+        """
+        Pile up the reads for a single reference sequence over a sorted list of
+        merged ROIs
+        """
+        starts = [start for start, _ in regions]
+        lastend = regions[-1][1]
+        depths = {}
+
+        for chunkstart, chunkend in self.region_chunks(refid, regions):
+            bgzf.seek(chunkstart)
+            while bgzf.tell() < chunkend:
+                sizebytes = bgzf.read(4)
+                if len(sizebytes) < 4:
+                    break
+                record = bgzf.read(struct.unpack("<i", sizebytes)[0])
+                (readref, pos, l_read_name, mapq, _, n_cigar, flag, l_seq,
+                 _, _, _) = ALIGNMENT_STRUCT.unpack_from(record)
+
+                # BAMs are coordinate sorted, so once we are past the last ROI
+                # on this chromosome there is nothing left to find
+                if readref != refid or pos >= lastend:
+                    break
+                if flag & self.exclude_flags or mapq < self.min_mapq:
+                    continue
+
+                offset = 32 + l_read_name
+                cigar = struct.unpack_from(f"<{n_cigar}I", record, offset)
+                offset += 4 * n_cigar + (l_seq + 1) // 2
+                qual = record[offset:offset + l_seq]
+                self.add_read(depths, pos, cigar, qual, starts, regions)
+        return depths
+
+    def add_read(self, depths: dict, pos: int, cigar: tuple, qual: bytes,
+                 starts: list, regions: list):
+        """
+        Add the aligned bases of a single read that fall within the ROIs
+        """
+        # 0xFF means base qualities are missing, in which case don't filter
+        checkqual = self.min_baseq > 0 and qual[:1] != b"\xff"
+        refpos = pos
+        qpos = 0
+        for op_len in cigar:
+            oplen = op_len >> 4
+            operation = op_len & 0xF
+            if operation in ALIGNED_OPS:
+                blockend = refpos + oplen
+                # Find the first region that could overlap this block
+                index = max(bisect_right(starts, refpos) - 1, 0)
+                while index < len(regions) and regions[index][0] < blockend:
+                    start = max(regions[index][0], refpos)
+                    end = min(regions[index][1], blockend)
+                    for base in range(start, end):
+                        if checkqual and qual[qpos + base - refpos] < self.min_baseq:
+                            continue
+                        # Depths are 1-based to match the VCF positions
+                        depths[base + 1] = depths.get(base + 1, 0) + 1
+                    index += 1
+            if CONSUMES_REF[operation]:
+                refpos += oplen
+            if CONSUMES_QUERY[operation]:
+                qpos += oplen
+
+
+def read_bam(bam, bedregions: list, min_mapq: int = 0,
+             min_baseq: int = 0) -> dict:
+    """
+    Return the {chrom: {pos: depth}} coverage dictionary for the ROIs in an
+    indexed BAM
+    """
+    return BamReader(bam, min_mapq, min_baseq).depth(bedregions)
@@ -0,0 +1,149 @@
+"""
+CoverageState
+=============
+
+Author: Ben.Sanders@NHS.net
+
+Keep track of the coverage already calculated for a run, so a rerun only has
+to recalculate the samples whose input files have changed.
+
+The state is a JSON file in the run's Coverage folder. It records a
+fingerprint (size and modification time) for each input file along with the
+coverage results calculated from it, plus the settings used (BED file hash,
+minimum depth, etc.). If the settings change, everything is recalculated. The
+report layout is recorded separately, as a layout change only needs the
+workbook rewriting from the cached results.
+"""
+
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+# Increase this if the format of the stored results changes, so old state
+# files are ignored rather than misread
+STATE_VERSION = 3
+
+
+def file_fingerprint(fpath) -> dict:
+    """
+    Cheap fingerprint for detecting a changed file, without reading it all
+    """
+    stat = Path(fpath).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def file_hash(fpath) -> str:
+    """SHA-256 of a (small) file, e.g. the BED file"""
+    with open(fpath, "rb") as fhandle:
+        return hashlib.sha256(fhandle.read()).hexdigest()
+
+
+def object_hash(obj) -> str:
+    """SHA-256 of any JSON serialisable object, e.g. the report layout"""
+    return hashlib.sha256(
+        json.dumps(obj, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class CoverageState():
+    """
+    Cached per-sample coverage results for a single run.
+
+    settings is a JSON serialisable dictionary of everything (other than the
+    input file itself) that affects the results.
+    """
+
+    def __init__(self, path, settings: dict):
+        self.path = Path(path)
+        self.settings = settings
+        self.samples = {}
+        self.workbook = None
+        self.changed = False
+        self.load()
+
+    def load(self):
+        """
+        Load the saved state, discarding it if it is unreadable or was made
+        with different settings
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as fhandle:
+                state = json.load(fhandle)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            print(f"WARNING: Could not read coverage state {self.path.name}",
+                  file=sys.stderr)
+            return
+
+        if (state.get("version") != STATE_VERSION
+                or state.get("settings") != self.settings):
+            print("INFO: Coverage settings have changed, recalculating all samples",
+                  file=sys.stderr)
+            return
+        self.samples = state.get("samples", {})
+        self.workbook = state.get("workbook")
+
+    def cached(self, fpath) -> dict:
+        """
+        Return the stored result for an input file, or None if it has not been
+        seen before or has changed since
+        """
+        entry = self.samples.get(Path(fpath).name)
+        if entry is None or entry["fingerprint"] != file_fingerprint(fpath):
+            return None
+        return entry["result"]
+
+    def update(self, fpath, result: dict):
+        """Store the result calculated from an input file"""
+        self.samples[Path(fpath).name] = {
+            "fingerprint": file_fingerprint(fpath),
+            "result": result,
+        }
+        self.changed = True
+
+    def prune(self, fpaths: list):
+        """Forget any input files that are no longer in the run"""
+        keep = {Path(fpath).name for fpath in fpaths}
+        for name in list(self.samples):
+            if name not in keep:
+                del self.samples[name]
+                self.changed = True
+
+    def workbook_current(self, workbook, layout_hash: str) -> bool:
+        """
+        Check if the workbook exists and was written from the current results
+        and layout
+        """
+        return (
+            not self.changed
+            and Path(workbook).is_file()
+            and self.workbook == {"name": Path(workbook).name,
+                                  "layout": layout_hash}
+        )
+
+    def set_workbook(self, workbook, layout_hash: str):
+        """Record that the workbook has been written with this layout"""
+        self.workbook = {"name": Path(workbook).name, "layout": layout_hash}
+
+    def save(self):
+        """
+        Write the state file. A temporary file is written first so an
+        interrupted run can't leave a half-written state behind.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmppath, "w", encoding="utf-8") as fhandle:
+            json.dump(
+                {
+                    "version": STATE_VERSION,
+                    "settings": self.settings,
+                    "workbook": self.workbook,
+                    "samples": self.samples,
+                },
+                fhandle,
+                indent=1,
+            )
+        os.replace(tmppath, self.path)
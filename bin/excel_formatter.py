@@ -2,14 +2,59 @@
 Author: Ben.Sanders@NHS.net
 
 Creates an Excel output file
+
+The report layout (panel positions, gene lists, bold genes, etc.) is passed
+in explicitly as a ReportLayout, so reports can be written without relying on
+the global config. load_settings (settings.py) builds one from
+transfer.config.
 """
 
 
 import datetime
 import sys
+from dataclasses import dataclass
 from pathlib import Path
 import xlsxwriter
-from bin.Config import config
+
+
+@dataclass
+class PanelLayout:
+    """
+    Position and gene list of a single panel on a sample sheet.
+
+    column and row are offsets from cell A1 for the panel header.
+    """
+    name: str
+    column: int
+    row: int
+    genes: list
+
+
+@dataclass
+class ReportLayout:
+    """
+    Everything needed to format the coverage workbook
+    """
+    panels: list
+    bold: list
+    mindepth: int
+    admin_email: str
+
+
+def write_report(results: list, layout: ReportLayout, path: Path,
+                 runid: str = None) -> Path:
+    """
+    Write a list of CoverageResults to an Excel workbook at path.
+
+    The parent folder is created if needed. If runid is not given, it is taken
+    from the folder above the output folder, matching the run folder layout.
+    """
+    path = Path(path)
+    if runid is None:
+        runid = path.parent.parent.name
+    formatter = ExcelFormatter(results, layout, path, runid)
+    formatter.write()
+    return path
 
 
 class ExcelFormatter():
@@ -20,31 +65,39 @@ class ExcelFormatter():
     coverage level, but this is adjustable via the config file.
     """
 
-    def __init__(self, outputdict: dict):
+    def __init__(self, results: list, layout: ReportLayout, path: Path,
+                 runid: str):
+        # Sort the samples by ID so the sheet order is stable
+        self.results = sorted(results, key=lambda result: result.sampleid)
+        self.layout = layout
+        self.path = Path(path)
+        self.outputpath = self.path.parent
+        self.runid = runid
+        self.workbook = None
 
-        # Get the output path from the first vcf path in the output
-        # Create a Path object and point it to the Coverage folder
-        self.outputdict = outputdict
-        self.outputpath = Path(next(iter(self.outputdict))).parent / "Coverage"
+    def write(self):
+        """
+        Create the workbook, write the summary and sample sheets, and close it
+        """
         self.outputpath.mkdir(exist_ok=True, parents=True)
-        self.runid = self.outputpath.parts[-2]
         print(
             f"INFO: Creating coverage folder at {self.outputpath}",
             file=sys.stderr,
         )
 
         # Create an empty Excel workbook in the output folder
-        self.workbook = xlsxwriter.Workbook(
-            self.outputpath / f"{self.runid}_Coverage.xlsx"
-        )
+        self.workbook = xlsxwriter.Workbook(self.path)
 
         # Write the summary/cover sheet
         self.write_summary()
 
-        # Loop through each sample in the dict
-        for sample in sorted(self.outputdict.keys()):
-            sampleid = Path(sample).parts[-1].split("_")[0]
-            self.write_sample(sample, sampleid)
+        # Loop through each sample in the results
+        for result in self.results:
+            self.write_sample(result)
+
+        # Per-base depths for the hotspots go on a final sheet of their own
+        if any(result.hotspots for result in self.results):
+            self.write_hotspots()
 
         self.workbook.close()
 
@@ -64,11 +117,11 @@ class ExcelFormatter():
         worksheet.write(
             5, 1, "Samples", self.workbook.add_format({"bold": True, "border": 1})
         )
-        for index, sample in enumerate(sorted(self.outputdict.keys())):
+        for index, result in enumerate(self.results):
             worksheet.write(
                 index + 6,
                 1,
-                Path(sample).parts[-1].split("_")[0],
+                result.sampleid,
                 self.workbook.add_format({"border": 1}),
             )
 
@@ -78,16 +131,16 @@ class ExcelFormatter():
         worksheet.write(
             6,
             3,
-            f"{config.get('coverage', 'mindepth')}x",
+            f"{self.layout.mindepth}x",
             self.workbook.add_format({"bold": True, "color": "red", "border": 1}),
         )
 
         # move the support footer line to just below the sample list, regardless of
         # how many samples are used
         tstamp = datetime.datetime.now().year
-        admin = config.get('general', 'admin_email')
+        admin = self.layout.admin_email
         worksheet.write(
-            len(self.outputdict.keys()) + 10,
+            len(self.results) + 10,
             1,
             f"WRGL software {tstamp}.  Contact {admin} for support",
             self.workbook.add_format({"color": "gray"}),
@@ -99,12 +152,13 @@ class ExcelFormatter():
         worksheet.set_column(3, 3, 20)
         worksheet.set_row(1, 30)
 
-    def write_sample(self, sample: str, sampleid: str):
+    def write_sample(self, result):
         """
         Uses XlsxWriter to make an Excel workbook containing the coverage summaries for
         every sample. Workbook name is taken from the run ID, and it is saved in the new
         data folder in a "Coverage" folder.
         """
+        sampleid = result.sampleid
         worksheet = self.workbook.add_worksheet(sampleid)
         print(f"INFO: Writing Excel report for {sampleid}", file=sys.stderr)
 
@@ -119,35 +173,35 @@ class ExcelFormatter():
         other_format = self.workbook.add_format({"border": 1, "num_format": "0.00%"})
 
         # Add each panel starting at the position defined in the transfer.config file.
-        for panel in config["panels"].getlist("panels"):
+        for panel in self.layout.panels:
 
             # Create an offset so that we can start genes from the cell below thier
             # header. Include a check for headers not on row 1, as these are merged
             # double height cells (no, I don't know why...)
             columnoffset = 1
             rowoffset = 0
-            if config.getint(panel, "row") != 0:
+            if panel.row != 0:
                 rowoffset = 1
 
             worksheet.merge_range(
-                config.getint(panel, "row"),
-                config.getint(panel, "column"),
-                config.getint(panel, "row") + rowoffset,
-                config.getint(panel, "column") + columnoffset,
-                panel,
+                panel.row,
+                panel.column,
+                panel.row + rowoffset,
+                panel.column + columnoffset,
+                panel.name,
                 header_format,
             )
 
             # now write the actual data, for each panel as defined in transfer.config
-            for index, gene in enumerate(config[panel].getlist("genes")):
+            for index, gene in enumerate(panel.genes):
                 # Calculate the percentage coverage for the current gene
-                length = self.outputdict[sample][gene][0]
-                covered = self.outputdict[sample][gene][1]
+                length = result.genes[gene][0]
+                covered = result.genes[gene][1]
                 coverage = covered / length
 
                 # Some genes should be highlighted in bold
                 # Check the list from transfer.config and change the format as appropriate
-                if gene in config["formatting"].getlist("bold"):
+                if gene in self.layout.bold:
                     gene_fmt = gene_bold_format
                 else:
                     gene_fmt = gene_format
@@ -157,14 +211,14 @@ class ExcelFormatter():
                 # NOTE: gene_fmt rather than gene_format below to allow bold to be set
                 #       above.
                 worksheet.write(
-                    config.getint(panel, "row") + (index + 1 + rowoffset),
-                    config.getint(panel, "column"),
+                    panel.row + (index + 1 + rowoffset),
+                    panel.column,
                     gene,
                     gene_fmt,
                 )
                 worksheet.write(
-                    config.getint(panel, "row") + (index + 1 + rowoffset),
-                    config.getint(panel, "column") + 1,
+                    panel.row + (index + 1 + rowoffset),
+                    panel.column + 1,
                     coverage,
                     other_format,
                 )
@@ -174,3 +228,49 @@ class ExcelFormatter():
         worksheet.set_column(10, 10, 25)
         worksheet.set_column(11, 11, 10)
         worksheet.set_row(0, 30)
+
+    def write_hotspots(self):
+        """
+        Write the depth at every base of each hotspot region, with one row per
+        base and one column per sample. Depths below the minimum are
+        highlighted in red.
+        """
+        worksheet = self.workbook.add_worksheet("Hotspot depths")
+        print("INFO: Writing hotspot depths to Excel report", file=sys.stderr)
+
+        header_format = self.workbook.add_format({"bold": True, "border": 1})
+        region_format = self.workbook.add_format({"italic": True, "border": 1})
+        depth_format = self.workbook.add_format({"border": 1})
+        low_format = self.workbook.add_format(
+            {"border": 1, "bold": True, "color": "red"}
+        )
+
+        headers = ["Region", "Chromosome", "Position"]
+        headers += [result.sampleid for result in self.results]
+        for column, header in enumerate(headers):
+            worksheet.write(0, column, header, header_format)
+
+        # Every sample is analysed with the same BED file, so the regions are
+        # taken from the first sample with any hotspots
+        regions = next(result.hotspots for result in self.results
+                       if result.hotspots)
+        row = 1
+        for index, region in enumerate(regions):
+            for offset, pos in enumerate(region.positions):
+                worksheet.write(row, 0, region.name, region_format)
+                worksheet.write(row, 1, str(region.chrom), depth_format)
+                worksheet.write(row, 2, pos, depth_format)
+                for column, result in enumerate(self.results, start=3):
+                    if index >= len(result.hotspots):
+                        continue
+                    depth = result.hotspots[index].depths[offset]
+                    if depth < self.layout.mindepth:
+                        worksheet.write(row, column, depth, low_format)
+                    else:
+                        worksheet.write(row, column, depth, depth_format)
+                row += 1
+
+        worksheet.freeze_panes(1, 3)
+        worksheet.set_column(0, 0, 25)
+        worksheet.set_column(1, 2, 12)
+        worksheet.set_column(3, 2 + len(self.results), 12)
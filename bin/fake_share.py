@@ -0,0 +1,202 @@
+"""
+FakeShare
+=========
+
+Author: Ben.Sanders@NHS.net
+
+Tools for benchmarking transfers without the live network share.
+
+make_msr_run and make_lrm_run build synthetic run folders with the same layout
+as the MiSeq (MSR) and Local Run Manager (LRM) outputs, filled with random
+data of a chosen size. SlowShare wraps a copy function to behave like an SMB
+share on a slow link. It adds a round trip of latency for each file lookup,
+open and write request, and limits the bandwidth, both per copy and shared
+across all copies. Copies to a local folder can then be timed reproducibly on
+Linux.
+
+The network model is deliberately simple (one round trip per write, no
+pipelining), so compare results against each other rather than expecting
+them to match the real share exactly.
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+
+from bin.quick_copy import quickcopy
+
+# Random data is written in blocks of this size and repeated, so large files
+# are quick to make but aren't sparse or trivially compressible
+BLOCK_SIZE = 1024 * 1024
+MB = 1024 * 1024
+
+
+def write_file(path: Path, size: int, block: bytes = None) -> Path:
+    """Write size bytes of random data to path, creating the folder"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    block = block or os.urandom(BLOCK_SIZE)
+    with open(path, "wb") as fhandle:
+        remaining = size
+        while remaining > 0:
+            fhandle.write(block[:remaining])
+            remaining -= len(block)
+    return path
+
+
+def write_sample_sheet(path: Path, samples: list) -> Path:
+    """Write a minimal SampleSheetUsed.csv listing the sample names"""
+    lines = ["[Header]", "IEMFileVersion,4", "", "[Data]",
+             "Sample_ID,Sample_Name,index,index2"]
+    lines += [f"{sample},{sample},ACGTACGT,TGCATGCA" for sample in samples]
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return Path(path)
+
+
+def _populate_run(rundir: Path, datadir: Path, fastqdir: Path,
+                  samples: int, fastq_mb: float, bam_mb: float,
+                  vcf_mb: float, interop_files: int, gzipped: bool):
+    """Fill in the files shared by both run layouts"""
+    block = os.urandom(BLOCK_SIZE)
+    names = [f"Sample{number}" for number in range(1, samples + 1)]
+
+    for fname in ("RunInfo.xml", "RunParameters.xml",
+                  "TruSight-Myeloid-Manifest.txt"):
+        write_file(rundir / fname, 4096, block)
+    # InterOp has a few large binary files and many small ones in subfolders
+    for index in range(interop_files):
+        subfolder = rundir / "InterOp" / ("" if index < 8 else "C1.1")
+        write_file(subfolder / f"Metrics{index}Out.bin",
+                   int(MB if index < 4 else 16 * 1024), block)
+
+    write_sample_sheet(datadir / "SampleSheetUsed.csv", names)
+    for fname in ("AmpliconCoverage_M1.tsv", "DemultiplexSummaryF1L1.txt"):
+        write_file(datadir / fname, 64 * 1024, block)
+
+    vcfsuffix = ".vcf.gz" if gzipped else ".vcf"
+    for number, name in enumerate(names, start=1):
+        prefix = f"{name}_S{number}"
+        write_file(datadir / f"{prefix}.genome{vcfsuffix}", int(vcf_mb * MB),
+                   block)
+        write_file(datadir / f"{prefix}{vcfsuffix}", 256 * 1024, block)
+        write_file(datadir / f"{prefix}.bam", int(bam_mb * MB), block)
+        write_file(datadir / f"{prefix}.bam.bai", 512 * 1024, block)
+        for read in ("R1", "R2"):
+            write_file(fastqdir / f"{prefix}_L001_{read}_001.fastq.gz",
+                       int(fastq_mb * MB), block)
+
+
+def make_msr_run(root, runid: str = "210101_M00000_0001_000000000-BENCH",
+                 samples: int = 8, fastq_mb: float = 64, bam_mb: float = 32,
+                 vcf_mb: float = 8, interop_files: int = 24) -> Path:
+    """
+    Build an MSR-style run folder under root, returning the Alignment folder
+    (the folder the transfer is started from)
+    """
+    rundir = Path(root) / runid
+    basecallsdir = rundir / "Data" / "Intensities" / "BaseCalls"
+    datadir = basecallsdir / "Alignment"
+    _populate_run(rundir, datadir, basecallsdir, samples, fastq_mb, bam_mb,
+                  vcf_mb, interop_files, gzipped=False)
+    return datadir
+
+
+def make_lrm_run(root, runid: str = "210101_M00000_0002_000000000-BENCH",
+                 samples: int = 8, fastq_mb: float = 64, bam_mb: float = 32,
+                 vcf_mb: float = 8, interop_files: int = 24) -> Path:
+    """
+    Build an LRM-style run folder (Alignment_1/<timestamp>, with gzipped VCFs
+    and a Fastq subfolder) under root, returning the analysis folder
+    """
+    rundir = Path(root) / runid
+    datadir = rundir / "Alignment_1" / "20210101_120000"
+    _populate_run(rundir, datadir, datadir / "Fastq", samples, fastq_mb,
+                  bam_mb, vcf_mb, interop_files, gzipped=True)
+    return datadir
+
+
+class _ThrottledProgress():
+    """
+    Stands in for the CopyProgress given to a copy, so each chunk written is
+    held up by the share before being counted
+    """
+
+    def __init__(self, share, progress):
+        self.share = share
+        self.progress = progress
+
+    def add(self, nbytes: int):
+        """Send a chunk over the fake link, then record it as copied"""
+        self.share.transmit(nbytes)
+        if self.progress is not None:
+            self.progress.add(nbytes)
+
+
+class SlowShare():
+    """
+    Wraps a copy function (quickcopy by default) so copies behave as though
+    the destination is a network share.
+
+    bandwidth_mb is the total MB/s shared by every copy using this share,
+    stream_mb is the most a single copy can reach, and latency_ms is the time
+    for each round trip. Each file costs one round trip to check if it exists
+    and, if it is copied, two more to open and close it. Each chunk written
+    by the copy costs one round trip, so larger copy buffers need fewer.
+    None or 0 means no limit.
+
+    An instance can be used directly as the TransferScheduler copy_function.
+    """
+
+    def __init__(self, copy_function=quickcopy, bandwidth_mb: float = None,
+                 stream_mb: float = None, latency_ms: float = 0):
+        self.copy_function = copy_function
+        self.bandwidth = (bandwidth_mb or 0) * MB
+        self.stream_bandwidth = (stream_mb or 0) * MB
+        self.latency = latency_ms / 1000
+        # Time at which the shared link will next be free
+        self.link_free = 0.0
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.sent_bytes = 0
+
+    def round_trip(self, count: int = 1):
+        """Wait for count request/response round trips"""
+        with self.lock:
+            self.round_trips += count
+        if self.latency:
+            time.sleep(self.latency * count)
+
+    def transmit(self, nbytes: int):
+        """
+        Block for as long as sending nbytes would take, queueing behind any
+        other copies using the link
+        """
+        now = time.monotonic()
+        finish = now
+        if self.stream_bandwidth:
+            finish = now + nbytes / self.stream_bandwidth
+        with self.lock:
+            self.sent_bytes += nbytes
+            if self.bandwidth:
+                self.link_free = (max(self.link_free, now)
+                                  + nbytes / self.bandwidth)
+                finish = max(finish, self.link_free)
+        delay = finish - now
+        if delay > 0:
+            time.sleep(delay)
+        self.round_trip()
+
+    def __call__(self, src, dst, progress=None, **kwargs):
+        """Copy src to dst through the fake share"""
+        # quickcopy skips files that already exist, which still costs a
+        # lookup on the share
+        self.round_trip()
+        existing = Path(dst).parent / Path(src).name
+        if existing.exists():
+            return self.copy_function(src, dst, progress=progress, **kwargs)
+        self.round_trip(2)
+        return self.copy_function(src, dst,
+                                  progress=_ThrottledProgress(self, progress),
+                                  **kwargs)
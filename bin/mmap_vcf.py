@@ -0,0 +1,215 @@
+"""
+MmapVcf
+=======
+
+Author: Ben.Sanders@NHS.net
+
+Read coverage for the BED regions of interest from a large, uncompressed
+genome VCF without reading the whole file.
+
+The file is memory-mapped, the header is skipped with a single search for the
+#CHROM line, and because genome VCFs are sorted by position we can binary
+search on line boundaries to find the start of each chromosome and then the
+first record of each ROI. Only the lines that overlap the ROIs are parsed, so
+the reading cost depends on the panel size rather than the file size.
+
+The output is the same {chrom: {pos: depth}} dictionary produced by
+Coverage.read_vcf, limited to the ROI positions.
+"""
+
+# Disable the "Consider using 'with'" warning, as the file stays open for the
+# life of the reader (which is itself a context manager)
+# pylint: disable=R1732
+
+import mmap
+from pathlib import Path
+
+from bin.quick_copy import print_line
+
+
+class UnsortedVcfError(ValueError):
+    """
+    Raised when the binary search finds the same chromosome in more than one
+    block of the file. Not every unsorted file can be detected this way, so
+    the VCF must still be sorted by position, as genome VCFs always are.
+    """
+
+
+class MmapVcfReader():
+    """
+    Random access to the records of an uncompressed, position sorted VCF
+    """
+
+    def __init__(self, vcf):
+        self.vcfpath = Path(vcf)
+        self.fhandle = open(self.vcfpath, "rb")
+        # mmap can't map an empty file
+        self.mmap = None
+        self._spans = None
+        try:
+            self.size = self.vcfpath.stat().st_size
+            if self.size:
+                self.mmap = mmap.mmap(self.fhandle.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                # Ignore any blank lines at the end of the file
+                while self.size and self.mmap[self.size - 1] in b"\r\n":
+                    self.size -= 1
+                self.size = self.next_line(self.size) if self.size else 0
+            self.datastart = self.find_data_start()
+        except BaseException:
+            # Don't leave the VCF open (and so locked on Windows)
+            self.close()
+            raise
+
+    def close(self):
+        """Release the memory map and file handle"""
+        if self.mmap is not None:
+            self.mmap.close()
+        self.fhandle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def find_data_start(self) -> int:
+        """
+        Return the offset of the first record, jumping past the header in one
+        search for the #CHROM line
+        """
+        if self.mmap is None:
+            return 0
+        if self.mmap[:1] != b"#":
+            return 0
+        index = self.mmap.find(b"\n#CHROM")
+        if index == -1:
+            # No column header line - step over the ## lines one at a time
+            offset = 0
+            while offset < self.size and self.mmap[offset:offset + 1] == b"#":
+                offset = self.next_line(offset)
+            return offset
+        return self.next_line(index + 1)
+
+    def next_line(self, offset: int) -> int:
+        """Return the start of the line after the one containing offset"""
+        index = self.mmap.find(b"\n", offset)
+        return len(self.mmap) if index == -1 else index + 1
+
+    def line_at_or_after(self, offset: int) -> int:
+        """Return offset if it is a line start, otherwise the next line start"""
+        if offset <= self.datastart:
+            return self.datastart
+        if self.mmap[offset - 1:offset] == b"\n":
+            return offset
+        return self.next_line(offset)
+
+    def record_key(self, offset: int) -> tuple:
+        """Return the (CHROM, POS) of the record starting at offset"""
+        lineend = self.next_line(offset)
+        tab1 = self.mmap.find(b"\t", offset, lineend)
+        tab2 = self.mmap.find(b"\t", tab1 + 1, lineend)
+        if tab1 == -1 or tab2 == -1:
+            raise ValueError(
+                f"ERROR: Invalid VCF record at byte {offset} of {self.vcfpath.name}"
+            )
+        return self.mmap[offset:tab1], int(self.mmap[tab1 + 1:tab2])
+
+    def _bisect(self, low: int, high: int, predicate) -> int:
+        """
+        Find the first line start in (low, high] for which predicate is True,
+        given that it is False for the line at low and True for any line at or
+        after high. Returns high if no earlier line matches.
+        """
+        while high - low > 1:
+            middle = (low + high) // 2
+            linestart = self.line_at_or_after(middle)
+            if linestart >= high or predicate(linestart):
+                high = middle
+            else:
+                low = middle
+        return self.line_at_or_after(high)
+
+    @property
+    def chromosome_spans(self) -> dict:
+        """
+        Map each chromosome name (as bytes) to the (start, end) byte offsets
+        of its block of records. Found by binary searching for the end of each
+        block, so only a handful of lines are read per chromosome.
+        """
+        if self._spans is None:
+            spans = {}
+            start = self.datastart
+            while start < self.size:
+                chrom = self.record_key(start)[0]
+                if chrom in spans:
+                    raise UnsortedVcfError(
+                        f"{self.vcfpath.name} is not sorted by chromosome"
+                    )
+                end = self._bisect(
+                    start, self.size,
+                    lambda offset, chrom=chrom: self.record_key(offset)[0] != chrom,
+                )
+                spans[chrom] = (start, end)
+                start = end
+            self._spans = spans
+        return self._spans
+
+    def find_position(self, start: int, end: int, pos: int) -> int:
+        """
+        Return the offset of the first record in the chromosome block
+        [start, end) with POS >= pos
+        """
+        if self.record_key(start)[1] >= pos:
+            return start
+        return self._bisect(
+            start, end, lambda offset: self.record_key(offset)[1] >= pos
+        )
+
+    def depths(self, chrom, regions: list) -> dict:
+        """
+        Read the depth for each position in a list of zero-based, half-open
+        (start, end) regions on a single chromosome. Positions with zero or
+        missing depth are skipped.
+        """
+        depths = {}
+        span = self.chromosome_spans.get(str(chrom).encode())
+        if span is None:
+            return depths
+        blockstart, blockend = span
+
+        for start, end in sorted(regions):
+            # BED is 0-indexed while the VCF is 1-indexed
+            offset = self.find_position(blockstart, blockend, start + 1)
+            while offset < blockend:
+                nextline = self.next_line(offset)
+                columns = self.mmap[offset:nextline].split(b"\t", 8)
+                pos = int(columns[1])
+                if pos > end:
+                    break
+                for field in columns[7].split(b";"):
+                    if field.startswith(b"DP="):
+                        depth = int(field[3:])
+                        if depth:
+                            depths[pos] = depth
+                offset = nextline
+        return depths
+
+
+def read_vcf_regions(vcf, bedregions: list) -> dict:
+    """
+    Return the {chrom: {pos: depth}} coverage dictionary for the ROIs in an
+    uncompressed, position sorted genome VCF
+    """
+    bychrom = {}
+    for chrom, start, end, _ in bedregions:
+        bychrom.setdefault(chrom, []).append((start, end))
+
+    coveragedict = {}
+    with MmapVcfReader(vcf) as reader:
+        for chrom, regions in bychrom.items():
+            print_line(f"INFO: Reading chromosome {chrom} coverage")
+            depths = reader.depths(chrom, regions)
+            if depths:
+                coveragedict[chrom] = depths
+    return coveragedict
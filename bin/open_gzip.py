@@ -19,20 +19,24 @@ import sys
 from typing import TextIO
 from pathlib import Path
 
+def is_gzipped(fname: str) -> bool:
+    """
+    Check the magic number to see if a file is gzipped
+    """
+    with open(fname, 'rb') as fhandle:
+        return fhandle.read(2) == b'\x1f\x8b'
+
 def open_gzip(fname: str) -> TextIO:
     """
     Open gzip or uncompressed file and return open filehandle
     """
-    try:
-        # we have to open the file twice - once to check
-        # it is a gzipped file
-        with open(fname, 'rb') as fhandle:
-            assert fhandle.read(2) == b'\x1f\x8b'
+    # we have to open the file twice - once to check
+    # it is a gzipped file
+    if is_gzipped(fname):
         # And again with gzip to read it as a text file.
         fhandle =  gzip.open(fname, "rt", encoding="utf-8")
-    except AssertionError:
-        # An assertion error means the file is NOT gzipped
-        # and can be opened as a normal file.
+    else:
+        # If the file is NOT gzipped it can be opened as a normal file.
         fhandle = open(fname, "r", encoding="utf-8")
     # Return the correctly opened file handle
     return fhandle
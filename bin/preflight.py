@@ -0,0 +1,129 @@
+"""
+Preflight
+=========
+
+Author: Ben.Sanders@NHS.net
+
+Quick checks run before any files are copied, so that problems which would
+otherwise only show up at the end of a long transfer and coverage run are
+reported straight away:
+
+ - the BED file exists, and every gene in the report panels is in it
+ - the target directory and BAM store can be written to
+ - all the essential run files are present
+ - there is enough free space on the target for the transfer
+
+The expected transfer size and time are also printed.
+"""
+
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+from bin.bed_reader import BedReader
+from bin.settings import Settings
+from bin.transfer_scheduler import format_bytes
+
+
+def check_writable(directory: Path) -> str:
+    """
+    Try to create a temporary file in a directory. os.access isn't reliable
+    on network shares, so actually writing is the only real test. Returns an
+    error message, or None if the directory is writable.
+    """
+    try:
+        with tempfile.TemporaryFile(dir=directory):
+            pass
+    except OSError as error:
+        return f"Cannot write to {directory}: {error}"
+    return None
+
+
+def check_bed(settings: Settings) -> list:
+    """
+    Check the BED file can be read and contains every gene in the report
+    panels
+    """
+    if not settings.bedfile.is_file():
+        return [f"BED file {settings.bedfile} does not exist"]
+
+    bedgenes = {region[3] for region in BedReader(settings.bedfile).bedfile}
+    problems = []
+    for panel in settings.layout.panels:
+        missing = [gene for gene in panel.genes if gene not in bedgenes]
+        if missing:
+            problems.append(
+                f"Genes in panel '{panel.name}' are not in {settings.bedfile.name}: "
+                f"{', '.join(missing)}"
+            )
+    return problems
+
+
+def check_transfer(settings: Settings, plan) -> list:
+    """
+    Check the destinations are writable, the essential source files exist and
+    there is room for the transfer, and print the expected size and time.
+    plan is the TransferPlan from MyeloidTransfer.plan_transfer.
+    """
+    problems = []
+
+    # The run folders themselves may not exist yet, so check the folders
+    # they will be created in
+    targetdir = plan.newrundir.parent
+    destinations = [targetdir]
+    if plan.bamstore is not None:
+        destinations.append(plan.bamstore.parent)
+    for directory in destinations:
+        problem = check_writable(directory)
+        if problem:
+            problems.append(problem)
+
+    missing = [str(job.src) for job in plan.jobs
+               if not job.optional and not job.src.is_file()]
+    if missing:
+        problems.append(f"Essential run files are missing: {', '.join(missing)}")
+
+    totalsize = sum(job.size for job in plan.jobs)
+    print(
+        f"INFO: Transfer of {len(plan.jobs)} files, {format_bytes(totalsize)}, "
+        f"expected to take about "
+        f"{totalsize / settings.expected_throughput / 60:.0f} minutes",
+        file=sys.stderr,
+    )
+
+    # Files already in the target are skipped, so only count the new ones
+    # against the free space
+    if not problems:
+        newsize = sum(job.size for job in plan.jobs
+                      if targetdir in job.dst.parents
+                      and not job.dst.exists())
+        free = shutil.disk_usage(targetdir).free
+        if newsize > free:
+            problems.append(
+                f"Not enough space in {targetdir}: "
+                f"{format_bytes(newsize)} needed, {format_bytes(free)} free"
+            )
+    return problems
+
+
+def run_preflight(settings: Settings, plan) -> None:
+    """
+    Run all the checks and exit with a list of problems if any fail
+    """
+    print("INFO: Running pre-flight checks", file=sys.stderr)
+    problems = check_bed(settings) + check_transfer(settings, plan)
+    if problems:
+        for problem in problems:
+            print(f"ERROR: {problem}", file=sys.stderr)
+        print("ERROR: Pre-flight checks failed, nothing has been copied",
+              file=sys.stderr)
+        sys.exit(1)
+    print("INFO: Pre-flight checks passed", file=sys.stderr)
+
+
+def report_settings_error(error) -> None:
+    """Print each problem with transfer.config and exit"""
+    for problem in error.problems:
+        print(f"ERROR: transfer.config: {problem}", file=sys.stderr)
+    sys.exit(1)
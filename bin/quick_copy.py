@@ -8,18 +8,267 @@ Adds a check for shutil copy functions to avoid overwriting existing files.
 This should help speed up transfers when (e.g.) fastq files have already been
 copied by the pipeline, while still allowing for full manual running if needed.
 
+Files are copied with buffered_copy, which uses a large buffer (the shutil
+default is tuned for local disks, not SMB shares), can preallocate the
+destination, and prints progress for long copies so that multi-GB fastq and
+BAM copies don't look like the program has frozen. Where both files are on
+local Linux filesystems the copy is done by the kernel
+(copy_file_range/sendfile) rather than through Python.
+
+Each file is copied to a temporary .part file, which is only renamed to the
+real name once the whole file has been written. An interrupted copy therefore
+can't be mistaken for a finished one and skipped on the next run.
+
 """
 
-from pathlib import Path
+import functools
+import os
 import shutil
+import sys
+import threading
+import time
+from pathlib import Path
+
+# 16MB reads/writes work well over SMB, where each request has a round trip
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024
+# Files smaller than this are copied without any progress messages
+PROGRESS_MIN_SIZE = 256 * 1024 * 1024
+# Minimum time (seconds) between progress messages for a single file
+PROGRESS_INTERVAL = 30.0
+# Suffix for files that are still being copied
+PARTIAL_SUFFIX = ".part"
+# Linux filesystem types that are network shares, or otherwise not safe or
+# quick for kernel copies
+NETWORK_FILESYSTEMS = {
+    "cifs", "smb3", "smbfs", "nfs", "nfs4", "afs", "ceph", "9p", "fuse",
+    "fuse.sshfs", "fuse.rclone", "davfs", "fuse.davfs2",
+}
+
+
+def print_line(message: str):
+    """
+    Print a message to stderr with its newline in the same write, so lines
+    from different threads or worker processes don't get mixed up
+    """
+    print(f"{message}\n", end="", file=sys.stderr)
 
 
-def quickcopy(src, dst, follow_symlinks=True):
+class CopyProgress():
     """
-    Use the shutil copy function, but check whether the file already exists.
+    Thread-safe running total of the bytes copied, shared by all the copies
+    in a run so the overall throughput can be reported
+    """
+
+    def __init__(self):
+        self.copied_bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, nbytes: int):
+        """Add to the number of bytes copied"""
+        with self.lock:
+            self.copied_bytes += nbytes
+
+
+def format_rate(nbytes: int, elapsed: float, total: int = None) -> str:
+    """
+    Format the amount copied, throughput and (if the total is known) ETA for
+    a progress message
+    """
+    rate = nbytes / max(elapsed, 1e-6)
+    message = f"{nbytes / 1024**2:.0f} MB"
+    if total:
+        message += f"/{total / 1024**2:.0f} MB ({nbytes / total:.0%})"
+    message += f" at {rate / 1024**2:.1f} MB/s"
+    if total and rate:
+        message += f", ETA {(total - nbytes) / rate:.0f}s"
+    return message
+
+
+@functools.lru_cache(maxsize=1)
+def _mount_points() -> list:
+    """
+    Read the mount points and filesystem types from /proc/self/mounts,
+    longest mount point first
+    """
+    mounts = []
+    try:
+        with open("/proc/self/mounts", "r", encoding="utf-8") as fhandle:
+            for line in fhandle:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces etc. in mount points are written as octal escapes
+                mountpoint = fields[1].encode("utf-8").decode("unicode_escape")
+                mounts.append((mountpoint, fields[2]))
+    except OSError:
+        return []
+    return sorted(mounts, key=lambda mount: len(mount[0]), reverse=True)
+
+
+def _filesystem_type(path) -> str:
+    """
+    The type of the filesystem holding path (e.g. ext4 or cifs), or None if it
+    can't be found
+    """
+    path = Path(path).resolve()
+    for mountpoint, fstype in _mount_points():
+        if path == Path(mountpoint) or Path(mountpoint) in path.parents:
+            return fstype
+    return None
+
+
+def _is_local(path) -> bool:
+    """
+    Kernel copies are only used on Linux, where the filesystem type can be
+    checked, and only when path is on a local (not network) filesystem. UNC
+    paths (\\\\server\\share) are always network paths.
+    """
+    if not sys.platform.startswith("linux") or str(path).startswith("\\\\"):
+        return False
+    fstype = _filesystem_type(path)
+    return fstype is not None and fstype not in NETWORK_FILESYSTEMS
+
+
+def _kernel_copy(infile, outfile, size: int, chunk_size: int, callback):
+    """
+    Copy using copy_file_range (or sendfile on older systems), in chunks so
+    progress can still be reported. Raises OSError if neither is supported
+    for these files, or if the copy stops early.
+    """
+    infd = infile.fileno()
+    outfd = outfile.fileno()
+    use_range = hasattr(os, "copy_file_range")
+    copied = 0
+    while copied < size:
+        count = min(chunk_size, size - copied)
+        if use_range:
+            try:
+                sent = os.copy_file_range(infd, outfd, count)
+            except OSError:
+                # e.g. a cross-filesystem copy on an older kernel
+                if copied:
+                    raise
+                use_range = False
+                continue
+        else:
+            sent = os.sendfile(outfd, infd, copied, count)
+        if sent == 0:
+            # Either the source is shorter than expected, or the kernel
+            # can't copy these files (so fall back to a buffered copy)
+            raise OSError(f"Kernel copy stopped after {copied} of {size} bytes")
+        copied += sent
+        callback(sent)
+    return copied
+
+
+def buffered_copy(src, dst, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                  preallocate: bool = False, progress: CopyProgress = None,
+                  report_interval: float = PROGRESS_INTERVAL):
+    """
+    Copy the contents of src to dst using a large buffer, returning dst.
+
+    The data is written to dst.part, which is renamed to dst once the copy is
+    complete. OSError is raised (and the .part file removed) if the number of
+    bytes copied doesn't match the size of src.
+
+    If preallocate is set, the destination is extended to its final size
+    before writing, which reduces fragmentation on the target disk. Progress
+    is added to the shared CopyProgress (if given), and for large files a
+    message with the throughput and ETA is printed every report_interval
+    seconds.
+    """
+    src = Path(src)
+    dst = Path(dst)
+    partial = dst.with_name(f"{dst.name}{PARTIAL_SUFFIX}")
+    size = src.stat().st_size
+    starttime = time.monotonic()
+    state = {"copied": 0, "reported": starttime}
+
+    def callback(nbytes: int):
+        state["copied"] += nbytes
+        if progress is not None:
+            progress.add(nbytes)
+        now = time.monotonic()
+        if size >= PROGRESS_MIN_SIZE and now - state["reported"] >= report_interval:
+            state["reported"] = now
+            rate = format_rate(state["copied"], now - starttime, size)
+            print_line(f"INFO: Copying {src.name}: {rate}")
+
+    try:
+        copied = _copy_data(src, partial, size, buffer_size, preallocate,
+                            callback)
+        if copied != size:
+            raise OSError(
+                f"Copied {copied} bytes of {src.name}, expected {size}. "
+                "The source may have changed during the copy."
+            )
+        os.replace(partial, dst)
+    except BaseException:
+        # Don't leave a partly copied file behind
+        try:
+            partial.unlink()
+        except OSError:
+            pass
+        raise
+
+    if size >= PROGRESS_MIN_SIZE:
+        rate = format_rate(copied, time.monotonic() - starttime)
+        print_line(f"INFO: Copied {src.name}: {rate}")
+    return dst
+
+
+def _copy_data(src: Path, dst: Path, size: int, buffer_size: int,
+               preallocate: bool, callback) -> int:
+    """
+    Copy the data for buffered_copy, returning the number of bytes copied
+    """
+    with open(src, "rb") as infile, open(dst, "wb") as outfile:
+        if preallocate and size:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(outfile.fileno(), 0, size)
+            else:
+                outfile.truncate(size)
+
+        if _is_local(src) and _is_local(dst):
+            sent = []
+
+            def kernel_callback(nbytes: int):
+                sent.append(nbytes)
+                callback(nbytes)
+
+            try:
+                return _kernel_copy(infile, outfile, size, buffer_size,
+                                    kernel_callback)
+            except OSError:
+                # Not supported for this pair of filesystems, so fall back to
+                # copying through a buffer. A failure part way through is a
+                # real error though.
+                if sent:
+                    raise
+                infile.seek(0)
+                outfile.seek(0)
+
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        copied = 0
+        while True:
+            nread = infile.readinto(buffer)
+            if not nread:
+                break
+            outfile.write(view[:nread])
+            copied += nread
+            callback(nread)
+    return copied
+
+
+def quickcopy(src, dst, follow_symlinks=True, buffer_size=DEFAULT_BUFFER_SIZE,
+              preallocate=False, progress=None):
+    """
+    Copy a file, but check whether the file already exists.
 
     Can be used in copytree as the copy_function to allow recursive copying
-    with checking.
+    with checking. Like shutil.copy, dst can be a folder, and the permission
+    bits are copied along with the data.
 
     NOTE: This does NOT check if src and dst are identical
     """
@@ -32,7 +281,17 @@ def quickcopy(src, dst, follow_symlinks=True):
     newfname = destpath / fname
     # test if the new file already exsists
     if newfname.exists():
+        # Count the skipped file as done, so the run progress is still right
+        if progress is not None:
+            progress.add(Path(src).stat().st_size)
         # Mimic the expected behaviour - return the path to the new file
         # Might need to be a string?
         return newfname
-    return shutil.copy(src, dst, follow_symlinks=follow_symlinks)
+
+    if Path(dst).is_dir():
+        dst = Path(dst) / fname
+    if not follow_symlinks and Path(src).is_symlink():
+        return shutil.copy(src, dst, follow_symlinks=False)
+    buffered_copy(src, dst, buffer_size, preallocate, progress)
+    shutil.copymode(src, dst)
+    return dst
@@ -0,0 +1,122 @@
+"""
+ResultBundle
+============
+
+Author: Ben.Sanders@NHS.net
+
+Write the coverage results as a gzip-compressed JSON lines file, so other
+systems (e.g. the LIMS import) can read them without parsing the Excel
+workbook.
+
+Each line is a single JSON object with a "type":
+
+ - "run": the first line, with the run ID, software version, thresholds,
+   coverage source and BED file name and hash
+ - "sample": one per sample, with the per-gene and per-region counts and the
+   per-base hotspot depths
+ - "end": the last line, with the number of samples
+
+Each sample is written and flushed as soon as it has been analysed. A bundle
+is only complete once the "end" line has been written, so anything reading it
+should check for that.
+"""
+
+import datetime
+import gzip
+import json
+import sys
+from pathlib import Path
+
+# Increase this if the format of the records changes
+BUNDLE_VERSION = 1
+
+
+def _fraction(covered: int, length: int) -> float:
+    """Fraction of bases covered, rounded to keep the file small"""
+    return round(covered / length, 6) if length else 0.0
+
+
+def sample_record(result) -> dict:
+    """Convert a CoverageResult into a "sample" record"""
+    return {
+        "type": "sample",
+        "sampleid": result.sampleid,
+        "file": Path(result.path).name,
+        "mindepth": result.mindepth,
+        "genes": [
+            {"gene": gene, "length": length, "covered": covered,
+             "fraction": _fraction(covered, length)}
+            for gene, (length, covered) in result.genes.items()
+        ],
+        "regions": [
+            {"chrom": chrom, "start": start, "end": end, "name": name,
+             "covered": covered, "fraction": _fraction(covered, end - start)}
+            for chrom, start, end, name, covered in result.regions
+        ],
+        "hotspots": [profile.to_dict() for profile in result.hotspots],
+    }
+
+
+class ResultBundle():
+    """
+    Streams coverage results to a gzipped JSON lines file. Use as a context
+    manager, calling add for each result as it is ready. metadata is written
+    into the "run" line.
+    """
+
+    def __init__(self, path, metadata: dict):
+        self.path = Path(path)
+        self.metadata = metadata
+        self.samples = 0
+        self.fhandle = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        print(f"INFO: Writing coverage results to {self.path.name}",
+              file=sys.stderr)
+        self.fhandle = gzip.open(self.path, "wt", encoding="utf-8")
+        self.write({
+            "type": "run",
+            "version": BUNDLE_VERSION,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            **self.metadata,
+        })
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # Only mark the bundle complete if every sample was written
+        if exc_type is None:
+            self.write({"type": "end", "samples": self.samples})
+        self.fhandle.close()
+
+    def write(self, record: dict):
+        """
+        Write a single record and flush it, so it can be read before the
+        bundle is finished
+        """
+        self.fhandle.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.fhandle.flush()
+
+    def add(self, result):
+        """Add a CoverageResult to the bundle"""
+        self.write(sample_record(result))
+        self.samples += 1
+
+
+def read_bundle(path) -> list:
+    """
+    Read all the records from a bundle. Raises ValueError if the bundle is
+    incomplete.
+    """
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as fhandle:
+        try:
+            for line in fhandle:
+                if line.strip():
+                    records.append(json.loads(line))
+        except EOFError:
+            # The bundle is still being written, or the run was interrupted
+            pass
+    if not records or records[-1].get("type") != "end":
+        raise ValueError(f"Coverage bundle {Path(path).name} is incomplete")
+    return records
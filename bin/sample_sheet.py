@@ -0,0 +1,164 @@
+"""
+SampleSheet
+===========
+
+Author: Ben.Sanders@NHS.net
+
+Read the samples from an Illumina SampleSheetUsed.csv, so we know exactly which
+samples (and so which VCF/BAM files) to expect in a run, rather than relying on
+globbing the run folder and splitting file names.
+
+MiSeq output files are named <Sample_Name>_S<n>, where n is the position of the
+sample in the [Data] section of the sheet (counting each sample once), and
+Sample_ID is used if there is no Sample_Name. Characters that aren't allowed in
+file names (including spaces) are replaced with "-", so "Pat 1" becomes
+Pat-1_S1.
+
+Each sample gets its own worksheet in the coverage report, named after the
+sample, so names must also be usable as Excel sheet names.
+"""
+
+import csv
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+# Anything other than these characters is replaced with "-" in output file
+# names
+INVALID_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9_-]")
+# Excel's limits on worksheet names, and the sheets the report already uses
+INVALID_SHEET_CHARS = re.compile(r"[\[\]:*?/\\]")
+MAX_SHEET_NAME = 31
+RESERVED_SHEET_NAMES = {"summary", "hotspot depths", "history"}
+
+
+def file_safe_name(name: str) -> str:
+    """Convert a sample name to the form used in the output file names"""
+    return INVALID_FILENAME_CHARS.sub("-", name)
+
+
+@dataclass
+class Sample:
+    """
+    A single sample from the [Data] section of the sample sheet
+    """
+    sample_id: str
+    sample_name: str
+    number: int
+    index: str = ""
+    index2: str = ""
+
+    @property
+    def prefix(self) -> str:
+        """The file name prefix used for this sample's output files"""
+        return f"{file_safe_name(self.name)}_S{self.number}"
+
+    @property
+    def name(self) -> str:
+        """The sample name used in the coverage report"""
+        return self.sample_name or self.sample_id
+
+    def expected_file(self, folder, suffix: str) -> Path:
+        """Path to one of this sample's output files, e.g. .genome.vcf"""
+        return Path(folder) / f"{self.prefix}{suffix}"
+
+
+def sheet_name_problem(name: str) -> str:
+    """
+    Check if a sample name can be used as a worksheet name, returning the
+    reason if not (or None if it can)
+    """
+    if INVALID_SHEET_CHARS.search(name):
+        return "contains one of []:*?/\\"
+    if len(name) > MAX_SHEET_NAME:
+        return f"is longer than {MAX_SHEET_NAME} characters"
+    if name.startswith("'") or name.endswith("'"):
+        return "starts or ends with '"
+    if name.lower() in RESERVED_SHEET_NAMES:
+        return "clashes with another sheet in the report"
+    return None
+
+
+def read_sample_sheet(fpath) -> list:
+    """
+    Read the samples from a sample sheet. The file is read line by line, and
+    the [Data] section is the only part that is parsed.
+
+    Raises ValueError if there is no [Data] section, if two samples have
+    the same name, or if a name can't be used as an Excel sheet name, as each
+    sample needs its own sheet in the report.
+    """
+    samples = []
+    numbers = {}
+    # Sample sheets saved from Excel often start with a byte order mark
+    with open(fpath, "r", encoding="utf-8-sig", newline="") as fhandle:
+        for line in fhandle:
+            if line.strip().lower().startswith("[data]"):
+                break
+        else:
+            raise ValueError(f"ERROR: No [Data] section in {fpath}")
+
+        for row in csv.DictReader(fhandle):
+            sample_id = (row.get("Sample_ID") or "").strip()
+            # Stop at a blank line or the start of any following section
+            if not sample_id or sample_id.startswith("["):
+                break
+            # A sample listed more than once keeps its first number
+            if sample_id not in numbers:
+                numbers[sample_id] = len(numbers) + 1
+                samples.append(Sample(
+                    sample_id,
+                    (row.get("Sample_Name") or "").strip(),
+                    numbers[sample_id],
+                    (row.get("index") or "").strip(),
+                    (row.get("index2") or "").strip(),
+                ))
+
+    # Excel sheet names aren't case sensitive, so neither is this check
+    seen = {}
+    for sample in samples:
+        problem = sheet_name_problem(sample.name)
+        if problem:
+            raise ValueError(
+                f"ERROR: Sample {sample.sample_id} in {Path(fpath).name} has "
+                f"the name '{sample.name}', which {problem} so can't be used "
+                "as a sheet in the coverage report"
+            )
+        other = seen.setdefault(sample.name.lower(), sample)
+        if other is not sample:
+            raise ValueError(
+                f"ERROR: Samples {other.sample_id} and {sample.sample_id} in "
+                f"{Path(fpath).name} have the same name '{sample.name}'"
+            )
+    return samples
+
+
+def match_sample_files(samples: list, folder, suffix: str) -> tuple:
+    """
+    Match the expected files for each sample against the files in a folder,
+    which is only listed once.
+
+    Returns a list of (Sample, Path) for the files found, a list of the
+    samples with no file, and a list of any other files with the same suffix
+    that don't belong to a sample in the sheet.
+    """
+    folder = Path(folder)
+    try:
+        with os.scandir(folder) as entries:
+            names = {entry.name for entry in entries
+                     if entry.name.endswith(suffix)}
+    except FileNotFoundError:
+        names = set()
+
+    found = []
+    missing = []
+    for sample in samples:
+        expected = sample.expected_file(folder, suffix)
+        if expected.name in names:
+            found.append((sample, expected))
+            names.discard(expected.name)
+        else:
+            missing.append(sample)
+    extra = [folder / name for name in sorted(names)]
+    return found, missing, extra
@@ -0,0 +1,181 @@
+"""
+Settings
+========
+
+Author: Ben.Sanders@NHS.net
+
+Load transfer.config once into a typed Settings object, checking every value
+up front. Problems (a missing option, a number that isn't a number, a panel
+without a section, etc.) are all collected and reported together, rather than
+surfacing one at a time as a KeyError or ValueError half way through a run.
+"""
+
+from configparser import ConfigParser, Error as ConfigError
+from dataclasses import dataclass
+from pathlib import Path
+
+from bin.excel_formatter import PanelLayout, ReportLayout
+
+COVERAGE_SOURCES = ("vcf", "bam")
+
+
+class SettingsError(ValueError):
+    """
+    Raised when transfer.config is invalid. problems lists every issue found.
+    """
+
+    def __init__(self, problems: list):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+@dataclass
+class Settings:
+    """
+    All the settings from transfer.config, converted to the right types
+    """
+    version: str
+    copy_fastqs: bool
+    copy_bams: bool
+    admin_email: str
+    source_dir: Path
+    target_dir: Path
+    bam_store_dir: Path
+    filetypes: list
+    max_datastore_copies: int
+    max_bamstore_copies: int
+    report_interval: float
+    copy_buffer_size: int
+    preallocate: bool
+    expected_throughput: float
+    verify: bool
+    verify_workers: int
+    verify_sample_size: int
+    mindepth: int
+    bedfile: Path
+    coverage_source: str
+    min_mapq: int
+    min_baseq: int
+    shard_workers: int
+    layout: ReportLayout
+
+
+class _Reader():
+    """
+    Wraps ConfigParser lookups so a bad value is recorded as a problem and a
+    default returned, letting the rest of the file still be checked
+    """
+
+    def __init__(self, cfg: ConfigParser):
+        self.cfg = cfg
+        self.problems = []
+
+    def get(self, section: str, option: str, getter: str = "get",
+            fallback=None, minimum=None):
+        """
+        Read an option with the named ConfigParser getter (get, getint, etc.).
+        Options with a fallback are optional.
+        """
+        try:
+            if fallback is None:
+                value = getattr(self.cfg, getter)(section, option)
+            else:
+                value = getattr(self.cfg, getter)(section, option,
+                                                  fallback=fallback)
+        except (ConfigError, ValueError) as error:
+            self.problems.append(f"[{section}] {option}: {error}")
+            return fallback
+        if minimum is not None and value is not None and value < minimum:
+            self.problems.append(
+                f"[{section}] {option} must be at least {minimum}, not {value}"
+            )
+        return value
+
+    def getlist(self, section: str, option: str) -> list:
+        """Read a comma separated list option"""
+        if not self.cfg.has_section(section):
+            self.problems.append(f"[{section}] section is missing")
+            return []
+        if not self.cfg.has_option(section, option):
+            self.problems.append(f"[{section}] {option} is missing")
+            return []
+        return self.cfg[section].getlist(option)
+
+
+def load_settings(cfg: ConfigParser) -> Settings:
+    """
+    Convert and check a transfer.config style ConfigParser.
+
+    Raises SettingsError listing every problem found.
+    """
+    reader = _Reader(cfg)
+
+    panels = []
+    for panel in reader.getlist("panels", "panels"):
+        if not cfg.has_section(panel):
+            reader.problems.append(
+                f"Panel '{panel}' is listed in [panels] but has no [{panel}] section"
+            )
+            continue
+        panels.append(PanelLayout(
+            panel,
+            reader.get(panel, "column", "getint", minimum=0),
+            reader.get(panel, "row", "getint", minimum=0),
+            reader.getlist(panel, "genes"),
+        ))
+
+    mindepth = reader.get("coverage", "mindepth", "getint", minimum=0)
+    admin_email = reader.get("general", "admin_email")
+    layout = ReportLayout(panels, reader.getlist("formatting", "bold"),
+                          mindepth, admin_email)
+
+    coverage_source = reader.get("coverage", "source", fallback="vcf")
+    if coverage_source not in COVERAGE_SOURCES:
+        reader.problems.append(
+            f"[coverage] source must be one of {', '.join(COVERAGE_SOURCES)}, "
+            f"not {coverage_source}"
+        )
+
+    settings = Settings(
+        version=reader.get("general", "version"),
+        copy_fastqs=reader.get("general", "copy_fastqs", "getboolean"),
+        copy_bams=reader.get("general", "copy_bams", "getboolean"),
+        admin_email=admin_email,
+        source_dir=Path(reader.get("directories", "source-dir") or ""),
+        target_dir=Path(reader.get("directories", "target-dir") or ""),
+        bam_store_dir=Path(reader.get("directories", "bam-store-dir") or ""),
+        filetypes=reader.getlist("directories", "filetypes"),
+        max_datastore_copies=reader.get("transfer", "max_datastore_copies",
+                                        "getint", fallback=1, minimum=1),
+        max_bamstore_copies=reader.get("transfer", "max_bamstore_copies",
+                                       "getint", fallback=1, minimum=1),
+        report_interval=reader.get("transfer", "report_interval", "getfloat",
+                                   fallback=10.0, minimum=0.1),
+        copy_buffer_size=reader.get("transfer", "copy_buffer_mb", "getint",
+                                    fallback=16, minimum=1) * 1024 * 1024,
+        preallocate=reader.get("transfer", "preallocate", "getboolean",
+                               fallback=False),
+        expected_throughput=reader.get("transfer", "expected_mb_per_sec",
+                                       "getfloat", fallback=40.0,
+                                       minimum=0.1) * 1024 * 1024,
+        verify=reader.get("transfer", "verify", "getboolean", fallback=True),
+        verify_workers=reader.get("transfer", "verify_workers", "getint",
+                                  fallback=4, minimum=1),
+        verify_sample_size=int(reader.get("transfer", "verify_sample_gb",
+                                          "getfloat", fallback=0.0,
+                                          minimum=0) * 1024**3),
+        mindepth=mindepth,
+        bedfile=Path(reader.get("coverage", "bedfile") or ""),
+        coverage_source=coverage_source,
+        min_mapq=reader.get("coverage", "min_mapq", "getint", fallback=0,
+                            minimum=0),
+        min_baseq=reader.get("coverage", "min_baseq", "getint", fallback=0,
+                             minimum=0),
+        shard_workers=reader.get("coverage", "shard_workers", "getint",
+                                 fallback=1, minimum=1),
+        layout=layout,
+    )
+
+    if reader.problems:
+        raise SettingsError(reader.problems)
+    return settings
@@ -0,0 +1,183 @@
+"""
+TransferScheduler
+=================
+
+Author: Ben.Sanders@NHS.net
+
+Run the file copies for a transfer concurrently, rather than one after another.
+
+Each destination (e.g. the datastore share and the BAM store) gets its own
+priority queue and a fixed number of copy workers, so a slow share can't be
+flooded with parallel writes but both destinations are used at the same time.
+Jobs with a lower priority number are copied first, so the small files that are
+needed for reporting land before the bulk fastq/BAM copies start filling the
+bandwidth.
+
+The copies themselves are blocking (shutil-style) calls, so they are run in a
+thread pool from asyncio. The copy function is given a shared CopyProgress,
+which it updates as data is written, so the throughput and ETA reported every
+few seconds include files that are still being copied.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from bin.quick_copy import CopyProgress, print_line, quickcopy
+
+# Job priorities - lower numbers are copied first
+PRIORITY_CRITICAL = 0
+PRIORITY_METADATA = 1
+PRIORITY_BULK = 2
+
+
+@dataclass
+class CopyJob:
+    """
+    A single file to copy.
+
+    destination names the concurrency pool the job belongs to. If optional is
+    set, a missing source file is skipped rather than treated as an error.
+    """
+    src: Path
+    dst: Path
+    destination: str
+    priority: int = PRIORITY_CRITICAL
+    optional: bool = False
+    message: str = None
+
+    @property
+    def size(self) -> int:
+        """Size of the source file, or 0 if it doesn't exist"""
+        try:
+            return self.src.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+
+def format_bytes(nbytes: float) -> str:
+    """Format a byte count for the progress messages"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
+
+class TransferScheduler():
+    """
+    Copy a list of CopyJobs with per-destination concurrency limits.
+
+    limits maps each destination name to the number of simultaneous copies
+    allowed. Destinations without a limit get a single worker. copy_function
+    is called as copy_function(src, dst, progress=CopyProgress).
+    """
+
+    def __init__(self, limits: dict, copy_function=quickcopy,
+                 report_interval: float = 10.0):
+        self.limits = limits
+        self.copy_function = copy_function
+        self.report_interval = report_interval
+        self.total_files = 0
+        self.total_bytes = 0
+        self.copied_files = 0
+        self.progress = CopyProgress()
+        self.errors = []
+        self.starttime = None
+        # The file counter is updated from the copy threads
+        self.lock = threading.Lock()
+
+    def run(self, jobs: list):
+        """
+        Copy all the jobs, blocking until they are done.
+
+        All jobs are attempted even if one fails, then the first error is
+        raised so the transfer still stops on an unexpected problem.
+        """
+        asyncio.run(self.run_async(jobs))
+        self.report(final=True)
+        if self.errors:
+            raise self.errors[0]
+
+    async def run_async(self, jobs: list):
+        """Copy all the jobs from within a running event loop"""
+        self.total_files = len(jobs)
+        self.total_bytes = sum(job.size for job in jobs)
+        self.starttime = time.monotonic()
+
+        # One priority queue per destination. The job index is used as a tie
+        # break so equal priority jobs keep their original order.
+        queues = {}
+        for index, job in enumerate(jobs):
+            queue = queues.setdefault(job.destination, asyncio.PriorityQueue())
+            queue.put_nowait((job.priority, index, job))
+
+        nworkers = sum(self.limits.get(dest, 1) for dest in queues)
+        with ThreadPoolExecutor(max_workers=max(nworkers, 1)) as executor:
+            workers = [
+                asyncio.create_task(self.worker(queue, executor))
+                for dest, queue in queues.items()
+                for _ in range(self.limits.get(dest, 1))
+            ]
+            reporter = asyncio.create_task(self.reporter())
+            await asyncio.gather(*workers)
+            reporter.cancel()
+
+    async def worker(self, queue: asyncio.PriorityQueue,
+                     executor: ThreadPoolExecutor):
+        """Copy jobs from a destination queue until it is empty"""
+        loop = asyncio.get_running_loop()
+        while not queue.empty():
+            _, _, job = queue.get_nowait()
+            # DEV: As with the original sequential copies, I don't know all
+            # the ways this might go wrong, so keep any error to raise once
+            # the other copies have finished.
+            try:
+                await loop.run_in_executor(executor, self.copy, job)
+            except Exception as error:  # pylint: disable=broad-except
+                print(f"ERROR: Failed to copy {job.src}: {error}",
+                      file=sys.stderr)
+                self.errors.append(error)
+
+    def copy(self, job: CopyJob):
+        """Copy a single job (runs in the thread pool)"""
+        if not job.src.exists() and job.optional:
+            return
+        print_line(job.message or f"INFO: Moving {job.src.name}")
+        job.dst.parent.mkdir(parents=True, exist_ok=True)
+        self.copy_function(job.src, job.dst, progress=self.progress)
+        with self.lock:
+            self.copied_files += 1
+
+    async def reporter(self):
+        """Print the transfer progress at regular intervals"""
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.report()
+
+    @property
+    def copied_bytes(self) -> int:
+        """Number of bytes copied so far, including partly copied files"""
+        return self.progress.copied_bytes
+
+    def report(self, final: bool = False):
+        """
+        Print the number of files and bytes copied, the throughput and the
+        estimated time remaining
+        """
+        elapsed = max(time.monotonic() - self.starttime, 1e-6)
+        rate = self.copied_bytes / elapsed
+        status = "Transfer complete" if final else "Transfer progress"
+        message = (
+            f"INFO: {status}: {self.copied_files}/{self.total_files} files, "
+            f"{format_bytes(self.copied_bytes)}/{format_bytes(self.total_bytes)} "
+            f"in {elapsed:.0f}s ({format_bytes(rate)}/s)"
+        )
+        if not final and rate:
+            remaining = max(self.total_bytes - self.copied_bytes, 0)
+            message += f", ETA {remaining / rate:.0f}s"
+        print(message, file=sys.stderr)
@@ -0,0 +1,275 @@
+"""
+VerifyTransfer
+==============
+
+Author: Ben.Sanders@NHS.net
+
+Check that every file copied by the transfer matches the original on the
+MiSeq, before the run is deleted from the instrument PC.
+
+Source and destination files are hashed (MD5, with large reads) on a thread
+pool, so several files are read at once over the network. The results are
+written into the new run folder as:
+
+ - md5sums.txt: standard "hash  path" lines for the files in the run folder,
+   so they can be checked later with md5sum -c
+ - transfer_manifest.json: every file checked (including the BAM store), with
+   the sizes, modification times and hashes of both copies
+
+When a run is verified again, files whose size and modification time haven't
+changed since the manifest was written aren't hashed again.
+
+Very large files (e.g. fastqs) can optionally be sample-hashed, where only
+evenly spaced chunks and the size are hashed. This is much quicker, and still
+catches truncated or badly corrupted copies, but isn't a full check, so these
+files are marked as sampled and left out of md5sums.txt.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from bin.coverage_state import file_fingerprint
+
+MANIFEST_NAME = "transfer_manifest.json"
+MD5SUMS_NAME = "md5sums.txt"
+# Increase this if the manifest format changes, so old manifests are ignored
+MANIFEST_VERSION = 1
+# Number and size of the chunks read when sample-hashing a large file
+SAMPLE_CHUNKS = 64
+SAMPLE_CHUNK_SIZE = 1024 * 1024
+
+
+def is_sampled(size: int, sample_size: int) -> bool:
+    """
+    Check if a file of this size is sample-hashed. Files smaller than the
+    sample itself are always hashed in full.
+    """
+    return bool(sample_size) and size > max(sample_size,
+                                            SAMPLE_CHUNKS * SAMPLE_CHUNK_SIZE)
+
+
+def hash_file(fpath, buffer_size: int = 16 * 1024 * 1024,
+              sample_size: int = 0) -> str:
+    """
+    MD5 of a file, read buffer_size bytes at a time.
+
+    If sample_size is set and the file is larger, only SAMPLE_CHUNKS evenly
+    spaced chunks (including the start and end) and the file size are hashed.
+    """
+    md5 = hashlib.md5()
+    size = Path(fpath).stat().st_size
+    with open(fpath, "rb") as fhandle:
+        if is_sampled(size, sample_size):
+            md5.update(str(size).encode("ascii"))
+            step = (size - SAMPLE_CHUNK_SIZE) / (SAMPLE_CHUNKS - 1)
+            for index in range(SAMPLE_CHUNKS):
+                fhandle.seek(int(index * step))
+                md5.update(fhandle.read(SAMPLE_CHUNK_SIZE))
+        else:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                nread = fhandle.readinto(buffer)
+                if not nread:
+                    break
+                md5.update(view[:nread])
+    return md5.hexdigest()
+
+
+@dataclass
+class VerifyResult:
+    """
+    Outcome of checking all the files from a transfer. failed lists a
+    message for each file that didn't match.
+    """
+    checked: int = 0
+    hashed: int = 0
+    unchanged: int = 0
+    sampled: int = 0
+    failed: list = field(default_factory=list)
+
+    @property
+    def passed(self) -> bool:
+        """True if every file matched"""
+        return not self.failed
+
+
+class TransferVerifier():
+    """
+    Hash the source and destination of each CopyJob in a transfer plan, and
+    write the manifest and md5sums.txt into the new run folder
+    """
+
+    def __init__(self, plan, workers: int = 4,
+                 buffer_size: int = 16 * 1024 * 1024, sample_size: int = 0):
+        self.plan = plan
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.sample_size = sample_size
+        self.manifest_path = plan.newrundir / MANIFEST_NAME
+        self.md5sums_path = plan.newrundir / MD5SUMS_NAME
+
+    def manifest_key(self, dst: Path) -> str:
+        """
+        Files in the run folder are listed relative to it, anything else (the
+        BAM store) by its full path
+        """
+        try:
+            return dst.relative_to(self.plan.newrundir).as_posix()
+        except ValueError:
+            return str(dst)
+
+    def load_manifest(self) -> dict:
+        """Load the file entries from a previous verification, if any"""
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as fhandle:
+                manifest = json.load(fhandle)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            print(f"WARNING: Could not read {MANIFEST_NAME}, rehashing all files",
+                  file=sys.stderr)
+            return {}
+        if (manifest.get("version") != MANIFEST_VERSION
+                or manifest.get("sample_size") != self.sample_size):
+            return {}
+        return manifest.get("files", {})
+
+    def hash(self, fpath: Path) -> str:
+        """Hash a single file with the verifier's settings"""
+        return hash_file(fpath, self.buffer_size, self.sample_size)
+
+    def verify(self) -> VerifyResult:
+        """
+        Check every copied file, reusing the previous hashes for any file
+        that hasn't changed, then write the manifest
+        """
+        print(f"INFO: Verifying transferred files for {self.plan.runid}",
+              file=sys.stderr)
+        previous = self.load_manifest()
+        result = VerifyResult()
+        entries = {}
+        tohash = []
+
+        for job in self.plan.jobs:
+            if not job.src.exists() and job.optional:
+                continue
+            key = self.manifest_key(job.dst)
+            result.checked += 1
+            if not job.dst.is_file():
+                result.failed.append(f"{key} is missing from the destination")
+                continue
+            if not job.src.is_file():
+                result.failed.append(f"{key} is missing from the source")
+                continue
+            entry = {
+                "src": str(job.src),
+                "src_fingerprint": file_fingerprint(job.src),
+                "dst_fingerprint": file_fingerprint(job.dst),
+            }
+            old = previous.get(key)
+            if (old is not None and old.get("status") == "ok"
+                    and old["src"] == entry["src"]
+                    and old["src_fingerprint"] == entry["src_fingerprint"]
+                    and old["dst_fingerprint"] == entry["dst_fingerprint"]):
+                entries[key] = old
+                result.unchanged += 1
+                result.sampled += old["sampled"]
+                continue
+            entry["sampled"] = is_sampled(entry["src_fingerprint"]["size"],
+                                          self.sample_size)
+            entries[key] = entry
+            tohash.append((key, job))
+
+        # Hash both copies of every new or changed file at the same time
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                (key, executor.submit(self.hash, job.src),
+                 executor.submit(self.hash, job.dst))
+                for key, job in tohash
+            ]
+            for key, srcfuture, dstfuture in futures:
+                entry = entries[key]
+                try:
+                    entry["md5"] = srcfuture.result()
+                    entry["dst_md5"] = dstfuture.result()
+                except OSError as error:
+                    entry["status"] = "error"
+                    result.failed.append(f"{key} could not be read: {error}")
+                    continue
+                result.hashed += 1
+                result.sampled += entry["sampled"]
+                if entry["md5"] == entry["dst_md5"]:
+                    entry["status"] = "ok"
+                else:
+                    entry["status"] = "mismatch"
+                    result.failed.append(f"{key} does not match the source")
+
+        self.write_manifest(entries)
+        self.report(result)
+        return result
+
+    def write_manifest(self, entries: dict):
+        """
+        Write the JSON manifest and md5sums.txt. Both are written to a
+        temporary file first, so an interrupted run can't leave a half-written
+        file behind.
+        """
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "runid": self.plan.runid,
+            "verified": datetime.datetime.now().isoformat(timespec="seconds"),
+            "sample_size": self.sample_size,
+            "files": entries,
+        }
+        # md5sums.txt paths are relative to the run folder, so the BAM store
+        # files can't be included
+        runfiles = {self.manifest_key(job.dst) for job in self.plan.jobs
+                    if self.plan.newrundir in job.dst.parents}
+        md5lines = [
+            f"{entry['md5']}  {key}\n"
+            for key, entry in sorted(entries.items())
+            if entry.get("status") == "ok" and not entry["sampled"]
+            and key in runfiles
+        ]
+        for path, write in (
+            (self.manifest_path,
+             lambda fhandle: json.dump(manifest, fhandle, indent=1)),
+            (self.md5sums_path, lambda fhandle: fhandle.writelines(md5lines)),
+        ):
+            tmppath = path.with_name(f"{path.name}.tmp")
+            with open(tmppath, "w", encoding="utf-8", newline="\n") as fhandle:
+                write(fhandle)
+            os.replace(tmppath, path)
+
+    def report(self, result: VerifyResult):
+        """Print the pass/fail summary"""
+        for problem in result.failed:
+            print(f"ERROR: Verification failed: {problem}", file=sys.stderr)
+        summary = (
+            f"{result.checked} files checked, {result.hashed} hashed, "
+            f"{result.unchanged} unchanged since the last check"
+        )
+        if result.sampled:
+            summary += f", {result.sampled} large files sample-hashed"
+        if result.passed:
+            print(f"INFO: Verification PASSED: {summary}", file=sys.stderr)
+        else:
+            print(
+                f"ERROR: Verification FAILED for {len(result.failed)} files "
+                f"({summary}). Do not delete the run from the MiSeq.",
+                file=sys.stderr,
+            )
+
+
+def verify_transfer(plan, workers: int = 4,
+                    buffer_size: int = 16 * 1024 * 1024,
+                    sample_size: int = 0) -> VerifyResult:
+    """Verify all the files in a TransferPlan, see TransferVerifier"""
+    return TransferVerifier(plan, workers, buffer_size, sample_size).verify()
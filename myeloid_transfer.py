@@ -3,11 +3,15 @@ Author: Ben.Sanders@NHS.net
 
 Main function to run the Myeloid data transfer and coverage report generation
 """
+import multiprocessing
 import sys
 from bin.Transfer import MyeloidTransfer
 from bin.Coverage import MyeloidCoverage
 
 if __name__ == "__main__":
+    # Coverage uses worker processes, which need this in a frozen executable
+    multiprocessing.freeze_support()
+
     # Transfer run folders from the MiSeq to the Z: drive
     # This handles asking for folders, transferring data, etc.
     try:
@@ -29,4 +33,4 @@ if __name__ == "__main__":
 
     # Now process the coverage information for this run
     # Automatically writes an Excel workbook as output
-    coverage = MyeloidCoverage(transfer.newdatadirectory)
+    coverage = MyeloidCoverage(transfer.newdatadirectory, transfer.settings)